@@ -0,0 +1,79 @@
+"""CloudFormation custom resource responses
+
+Shared by the custom resources in this package, whose zips bundle it as
+``customresources/cfnresponse.py`` (see ``tools/package_lambdas``).
+
+"""
+from __future__ import print_function
+
+import json
+import random
+import socket
+import time
+import urllib2
+
+
+SUCCESS = "SUCCESS"
+FAILED = "FAILED"
+# Response delivery to the CloudFormation ResponseURL
+SEND_TIMEOUT = 10
+SEND_ATTEMPTS = 5
+SEND_BACKOFF = 0.5
+# CloudFormation rejects responses larger than this, in bytes
+MAX_RESPONSE_BODY = 4096
+
+
+def send(event, context, response_status, reason=None, response_data=None,
+         physical_resource_id=None, on_attempt=None):
+    """PUT a response to the request's ResponseURL, True if it arrived
+
+    Server and connection errors are retried with exponential backoff,
+    client errors such as an expired URL aren't. on_attempt, if given,
+    is called with the number of every attempt.
+
+    Raises ValueError without sending anything if the response is over
+    MAX_RESPONSE_BODY bytes.
+
+    """
+    reason = reason or "See the details in CloudWatch Log Stream: " + \
+        context.log_stream_name
+    response_body = json.dumps(
+        {
+            'Status': response_status,
+            'Reason': reason,
+            'PhysicalResourceId': physical_resource_id or
+            context.log_stream_name,
+            'StackId': event['StackId'],
+            'RequestId': event['RequestId'],
+            'LogicalResourceId': event['LogicalResourceId'],
+            'Data': response_data or {}
+        }
+    )
+    if len(response_body) > MAX_RESPONSE_BODY:
+        raise ValueError("Response is {} bytes, over the {} byte limit of "
+                         "CloudFormation".format(len(response_body),
+                                                 MAX_RESPONSE_BODY))
+
+    opener = urllib2.build_opener(urllib2.HTTPHandler)
+    request = urllib2.Request(event["ResponseURL"], data=response_body)
+    request.add_header("Content-Type", "")
+    request.add_header("Content-Length", len(response_body))
+    request.get_method = lambda: 'PUT'
+    for attempt in range(1, SEND_ATTEMPTS + 1):
+        if on_attempt is not None:
+            on_attempt(attempt)
+        try:
+            response = opener.open(request, timeout=SEND_TIMEOUT)
+            print("Status code: {}".format(response.getcode()))
+            print("Status message: {}".format(response.msg))
+            return True
+        except urllib2.HTTPError as exc:
+            print("Failed executing HTTP request: {}".format(exc.code))
+            if exc.code < 500:
+                return False
+        except (urllib2.URLError, socket.error) as exc:
+            print("Failed executing HTTP request: {}".format(exc))
+        if attempt < SEND_ATTEMPTS:
+            # Exponential backoff with full jitter
+            time.sleep(random.uniform(0, SEND_BACKOFF * 2 ** attempt))
+    return False
@@ -0,0 +1,204 @@
+"""Lambda VPC network interface cleanup CloudFormation Custom resource
+
+Lambda functions in a VPC leave their network interfaces behind for a
+while after they are deleted, and those keep their security groups from
+being deleted. On Delete this resource detaches and deletes the Lambda
+network interfaces in ``SecurityGroupIds`` concurrently, retrying with
+backoff until none are left. Create and Update do nothing.
+
+Declare it depending on the security groups, and the Lambda function
+depending on it, so stack deletion runs it after the function is gone
+and before the groups are deleted.
+
+"""
+from __future__ import print_function
+
+import json
+import sys
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+from customresources.cfnresponse import FAILED, SUCCESS, send
+
+
+MAX_CONCURRENCY = 8
+# Lambda network interfaces are tagged by their description
+LAMBDA_DESCRIPTION = "AWS Lambda VPC ENI"
+# Backoff between cleanup rounds, in seconds
+MIN_BACKOFF = 5.0
+MAX_BACKOFF = 60.0
+BACKOFF = 2.0
+# Hand over to a fresh invocation when less time than this remains
+TIMEOUT_MARGIN_MS = 30 * 1000
+MAX_CONTINUATIONS = 10
+# Already gone, or detaching/deleting is already under way
+GONE_ERRORS = ["InvalidNetworkInterfaceID.NotFound",
+               "InvalidAttachmentID.NotFound"]
+
+# Clients are kept across warm invocations of the container
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def client(service):
+    """Returns the cached boto3 client for a service"""
+    with _clients_lock:
+        if service not in _clients:
+            _clients[service] = boto3.client(service)
+        return _clients[service]
+
+
+def lambda_interfaces(ec2, group_ids):
+    """Returns the Lambda network interfaces in any of the groups"""
+    filters = [{"Name": "group-id", "Values": list(group_ids)}]
+    if ec2.can_paginate("describe_network_interfaces"):
+        pages = ec2.get_paginator("describe_network_interfaces").paginate(
+            Filters=filters)
+    else:
+        # Older botocore, from before the API paged its results
+        pages = [ec2.describe_network_interfaces(Filters=filters)]
+    return [eni for page in pages for eni in page["NetworkInterfaces"]
+            if eni.get("Description", "").startswith(LAMBDA_DESCRIPTION)]
+
+
+def _error_code(exc):
+    return exc.response.get("Error", {}).get("Code")
+
+
+def release(ec2, eni):
+    """Detach or delete one network interface, returns True once gone
+
+    An attached interface is detached, it can only be deleted once
+    available in a later round. Errors are left to the next round.
+
+    """
+    eni_id = eni["NetworkInterfaceId"]
+    try:
+        attachment = eni.get("Attachment")
+        if eni["Status"] == "in-use" and attachment:
+            ec2.detach_network_interface(
+                AttachmentId=attachment["AttachmentId"], Force=True)
+            print("Detaching {}".format(eni_id))
+            return False
+        if eni["Status"] == "available":
+            ec2.delete_network_interface(NetworkInterfaceId=eni_id)
+            print("Deleted {}".format(eni_id))
+            return True
+    except ClientError as exc:
+        if _error_code(exc) in GONE_ERRORS:
+            return True
+        print("Releasing {} failed: {}".format(eni_id, exc))
+    return False
+
+
+def release_all(ec2, group_ids, max_workers=MAX_CONCURRENCY):
+    """One concurrent round over the groups' Lambda network interfaces
+
+    Returns how many interfaces are left.
+
+    """
+    enis = lambda_interfaces(ec2, group_ids)
+    if not enis:
+        return 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        gone = list(executor.map(lambda eni: release(ec2, eni), enis))
+    return gone.count(False)
+
+
+def cleanup(ec2, group_ids, out_of_time, max_workers=MAX_CONCURRENCY,
+            sleep=time.sleep):
+    """Release rounds with backoff until no interfaces are left
+
+    Returns False if out_of_time() says to stop first.
+
+    """
+    delay = MIN_BACKOFF
+    while True:
+        remaining = release_all(ec2, group_ids, max_workers)
+        if not remaining:
+            return True
+        print("{} network interfaces left, retrying in {}s".format(
+            remaining, delay))
+        if out_of_time(delay):
+            return False
+        sleep(delay)
+        delay = min(delay * BACKOFF, MAX_BACKOFF)
+
+
+def _physical_id(event):
+    return "eni-cleanup-" + "-".join(
+        event["ResourceProperties"]["SecurityGroupIds"])
+
+
+def _continue_delete(event, context):
+    """Re-invoke this function to carry on with an unfinished cleanup"""
+    continuation = event.get("Continuation", 0) + 1
+    if continuation > MAX_CONTINUATIONS:
+        return False
+    print("Out of time, continuing cleanup in invocation {}".format(
+        continuation))
+    client("lambda").invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps(dict(event, Continuation=continuation)),
+    )
+    return True
+
+
+def create(event, context):
+    send(event, context, SUCCESS, physical_resource_id=_physical_id(event))
+
+
+def delete(event, context):
+    """Clean up the network interfaces, then respond
+
+    Runs out of invocations with SUCCESS anyway, so the stack deletion
+    goes on and only the security groups fail to delete.
+
+    """
+    props = event["ResourceProperties"]
+    max_workers = int(props.get("MaxConcurrency", MAX_CONCURRENCY))
+
+    def out_of_time(delay):
+        return context.get_remaining_time_in_millis() < \
+            TIMEOUT_MARGIN_MS + delay * 1000
+
+    done = cleanup(client("ec2"), props["SecurityGroupIds"],
+                   out_of_time, max_workers)
+    reason = None
+    if not done:
+        if _continue_delete(event, context):
+            return
+        reason = "Network interfaces left after {} invocations".format(
+            MAX_CONTINUATIONS + 1)
+    send(event, context, SUCCESS, reason=reason,
+         physical_resource_id=event["PhysicalResourceId"])
+
+
+HANDLERS = {
+    "Delete": delete,
+    "Update": create,
+    "Create": create
+}
+
+
+def lambda_handler(event, context):
+    handler = HANDLERS.get(event["RequestType"])
+    try:
+        return handler(event, context)
+    except Exception:
+        msg = ""
+        for err in sys.exc_info():
+            msg += "\n{}\n".format(err)
+        response_data = {
+            "Error": "{} resource failed: {}".format(event["RequestType"], msg)
+        }
+        print(response_data)
+        # A failed cleanup shouldn't stop the rest of the stack deletion
+        status = SUCCESS if event["RequestType"] == "Delete" else FAILED
+        return send(event, context, status, response_data=response_data,
+                    physical_resource_id=event.get("PhysicalResourceId"))
@@ -10,94 +10,471 @@ https://github.com/humilis/humilis-firehose-resource/blob/master/LICENSE
 from __future__ import print_function
 
 import base64
+import hashlib
 import json
 import sys
-import urllib2
-import StringIO
+import threading
+import time
 
 import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+from customresources import cfnresponse
+from customresources.cfnresponse import FAILED, SUCCESS
 
 
-SUCCESS = "SUCCESS"
-FAILED = "FAILED"
 FINAL_STATES = ['ACTIVE']
+MAX_CONCURRENCY = 8
+# Source objects larger than this many bytes are copied in parts
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+# S3 rejects non-final parts smaller than 5MB
+MIN_PART_SIZE = 5 * 1024 * 1024
+# Object metadata holding the hash of the content that was written
+HASH_METADATA = "content-sha256"
+# Object metadata holding the physical id of the resource that wrote it
+OWNER_METADATA = "s3writer-owner"
+# delete_objects accepts at most this many keys per request
+DELETE_BATCH_SIZE = 1000
+# Stack states in which deleted resources were replaced or removed
+CLEANUP_SUFFIX = "_CLEANUP_IN_PROGRESS"
+# Hand over to a fresh invocation when less time than this remains
+TIMEOUT_MARGIN_MS = 30 * 1000
+MAX_CONTINUATIONS = 10
+# Longest error message put in a FAILED response, which has to fit in
+# cfnresponse.MAX_RESPONSE_BODY
+MAX_ERROR_LENGTH = 2048
+
+# Clients are kept across warm invocations of the container
+_clients = {}
+_clients_lock = threading.Lock()
+# Per-invocation timings, kept per thread
+_timings = threading.local()
+
+
+def client(service):
+    """Returns the cached boto3 client for a service"""
+    with _clients_lock:
+        if service not in _clients:
+            _clients[service] = boto3.client(service)
+        return _clients[service]
+
+
+def _count_attempt(attempt):
+    _timings.send_attempts = attempt
 
 
 def send(event, context, response_status, reason=None, response_data=None,
          physical_resource_id=None):
-    response_data = response_data or {}
-    reason = reason or "See the details in CloudWatch Log Stream: " + \
-        context.log_stream_name
-    physical_resource_id = physical_resource_id or context.log_stream_name
-    response_body = json.dumps(
-        {
-            'Status': response_status,
-            'Reason': reason,
-            'PhysicalResourceId': physical_resource_id,
-            'StackId': event['StackId'],
-            'RequestId': event['RequestId'],
-            'LogicalResourceId': event['LogicalResourceId'],
-            'Data': response_data
-        }
-    )
+    """cfnresponse.send, timing the response delivery"""
+    started = time.time()
+    try:
+        return cfnresponse.send(event, context, response_status, reason,
+                                response_data, physical_resource_id,
+                                on_attempt=_count_attempt)
+    finally:
+        _timings.response = time.time() - started
+
+
+def _file_list(filecfg):
+    """Returns the file dicts to write for a resource
+
+    Either the resource itself describes a single file, or it has a
+    ``Files`` list of dicts each describing their own file. A file has a
+    ``Key`` and either ``Content`` or a ``Source`` dict naming the
+    ``Bucket`` and ``Key`` of an existing S3 object to copy.
+
+    A resource with only a ``Prefix`` has no files.
+
+    """
+    if "Files" in filecfg:
+        return filecfg["Files"]
+    if "Key" in filecfg:
+        return [filecfg]
+    return []
+
+
+def _physical_id(event, s3_bucket):
+    """Physical resource id of a resource writing to a bucket
+
+    It only depends on the bucket and the stack and logical id of the
+    resource, so changing the files of a resource never replaces it.
+
+    """
+    stack_name = event["StackId"].split("/")[1]
+    return "s3writer:{}:{}:{}".format(s3_bucket, stack_name,
+                                      event["LogicalResourceId"])
+
+
+def _keys_digest(keys):
+    """SHA1 hex digest of a set of keys, independent of their order"""
+    return hashlib.sha1(u"\n".join(sorted(keys)).encode("utf-8")).hexdigest()
+
+
+def _files_arn(s3_bucket, keys, prefix=None):
+    """ARN-like id covering all the keys of a resource
+
+    A single file keeps the plain ``arn:aws:s3:::bucket:key`` form, a
+    batch of files is identified by a digest of its sorted keys and a
+    prefix-only resource by its prefix.
+
+    """
+    if not keys and prefix is not None:
+        return u"arn:aws:s3:::{}:{}*".format(s3_bucket, prefix)
+    if len(keys) == 1:
+        return u"arn:aws:s3:::{}:{}".format(s3_bucket, keys[0])
+    return u"arn:aws:s3:::{}:files-{}".format(s3_bucket, _keys_digest(keys))
+
+
+def _multipart_upload(s3, s3_bucket, s3_key, file_type, metadata,
+                      upload_parts):
+    """Run a multipart upload, aborting it if any part fails
 
-    opener = urllib2.build_opener(urllib2.HTTPHandler)
-    request = urllib2.Request(event["ResponseURL"], data=response_body)
-    request.add_header("Content-Type", "")
-    request.add_header("Content-Length", len(response_body))
-    request.get_method = lambda: 'PUT'
+    upload_parts is called with the upload id and returns the list of
+    completed parts.
+
+    """
+    upload_id = s3.create_multipart_upload(
+        Bucket=s3_bucket, Key=s3_key, ContentType=file_type,
+        Metadata=metadata)["UploadId"]
     try:
-        response = opener.open(request)
-        print("Status code: {}".format(response.getcode()))
-        print("Status message: {}".format(response.msg))
-        return True
-    except urllib2.HTTPError as exc:
-        print("Failed executing HTTP request: {}".format(exc.code))
+        parts = upload_parts(upload_id)
+        s3.complete_multipart_upload(
+            Bucket=s3_bucket, Key=s3_key, UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except Exception:
+        s3.abort_multipart_upload(Bucket=s3_bucket, Key=s3_key,
+                                  UploadId=upload_id)
+        raise
+
+
+def _copy_object(s3, s3_bucket, s3_key, copy_source, head, metadata,
+                 threshold, part_size, part_executor=None):
+    """Server-side copy of a source S3 object
+
+    Objects above the threshold are copied as a multipart upload, whose
+    part copies run concurrently in part_executor when it's given.
+
+    """
+    size = head["ContentLength"]
+    file_type = head.get("ContentType", "binary/octet-stream")
+    if size <= threshold:
+        s3.copy_object(Bucket=s3_bucket, Key=s3_key, CopySource=copy_source,
+                       ContentType=file_type, Metadata=metadata,
+                       MetadataDirective="REPLACE")
+        return
+
+    def upload_parts(upload_id):
+        def copy_part(number):
+            first = (number - 1) * part_size
+            last = min(first + part_size, size) - 1
+            resp = s3.upload_part_copy(
+                Bucket=s3_bucket, Key=s3_key, UploadId=upload_id,
+                PartNumber=number, CopySource=copy_source,
+                CopySourceRange="bytes={}-{}".format(first, last),
+            )
+            return {"PartNumber": number,
+                    "ETag": resp["CopyPartResult"]["ETag"]}
+
+        count = (size + part_size - 1) // part_size
+        run = part_executor.map if part_executor is not None else map
+        return list(run(copy_part, xrange(1, count + 1)))
+
+    _multipart_upload(s3, s3_bucket, s3_key, file_type, metadata,
+                      upload_parts)
+
+
+def _existing_object(s3, s3_bucket, s3_key):
+    """Returns the head of an object, or None if it doesn't exist"""
+    try:
+        return s3.head_object(Bucket=s3_bucket, Key=s3_key)
+    except ClientError as exc:
+        if exc.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+
+
+def _unchanged(s3, s3_bucket, s3_key, content_hash, owner, body=None):
+    """Whether the object already holds the content being written
+
+    Objects written by this resource carry the content hash in their
+    metadata. Other objects are matched on their ETag, which is the MD5
+    of the body for anything that wasn't a multipart upload.
+
+    An object holding the content but owned by another physical id is
+    claimed with a metadata-only copy onto itself.
+
+    """
+    head = _existing_object(s3, s3_bucket, s3_key)
+    if head is None:
         return False
+    metadata = head.get("Metadata", {})
+    stored_hash = metadata.get(HASH_METADATA)
+    if stored_hash is not None:
+        if stored_hash != content_hash:
+            return False
+    elif body is None or \
+            head["ETag"].strip('"') != hashlib.md5(body).hexdigest():
+        return False
+    if metadata.get(OWNER_METADATA) != owner:
+        s3.copy_object(
+            Bucket=s3_bucket, Key=s3_key,
+            CopySource={"Bucket": s3_bucket, "Key": s3_key},
+            ContentType=head.get("ContentType", "binary/octet-stream"),
+            Metadata={HASH_METADATA: content_hash, OWNER_METADATA: owner},
+            MetadataDirective="REPLACE",
+        )
+    return True
 
 
-def create_file(event, context):
-    """Create a S3 file
+def write_file(s3, s3_bucket, filecfg, owner, threshold=MULTIPART_THRESHOLD,
+               part_size=PART_SIZE, part_executor=None):
+    """Write a single S3 file, returns whether it was written
 
     If the Content is a dict, it will be JSON serialized to S3.
     Otherwise the Content is assumed to be base64 encoded and will
-    be decoded before it is written.
+    be decoded before it is written. Content arrives in the request, which
+    Lambda caps at 256KB, so it's always a single put_object. A Source is
+    copied server-side without passing through the Lambda, in parts above
+    threshold bytes.
+
+    Nothing is written when the object already holds the same content.
+    Written objects are marked as owned by the owner physical id.
 
     """
-    filecfg = event["ResourceProperties"]
-    s3_bucket = filecfg["Bucket"]
     s3_key = filecfg["Key"]
+    if "Source" in filecfg:
+        source = filecfg["Source"]
+        copy_source = {"Bucket": source["Bucket"], "Key": source["Key"]}
+        head = s3.head_object(**copy_source)
+        content_hash = hashlib.sha256("{Bucket}/{Key}:".format(
+            **copy_source) + head["ETag"]).hexdigest()
+        if _unchanged(s3, s3_bucket, s3_key, content_hash, owner):
+            return False
+        _copy_object(s3, s3_bucket, s3_key, copy_source, head,
+                     {HASH_METADATA: content_hash, OWNER_METADATA: owner},
+                     threshold, part_size, part_executor)
+        return True
+
     content = filecfg["Content"]
-    file_type = "text/plain"
     if isinstance(content, dict):
         file_type = "application/json"
-        content = json.dumps(content)
+        body = json.dumps(content)
+        content_hash = hashlib.sha256(body).hexdigest()
     else:
-        content = base64.urlsafe_b64decode(content)
+        file_type = "text/plain"
+        content_hash = hashlib.sha256(content).hexdigest()
+        body = base64.urlsafe_b64decode(content)
+    if _unchanged(s3, s3_bucket, s3_key, content_hash, owner, body):
+        return False
+
+    s3.put_object(Bucket=s3_bucket, Key=s3_key, ContentType=file_type,
+                  Metadata={HASH_METADATA: content_hash,
+                            OWNER_METADATA: owner},
+                  Body=body)
+    return True
 
-    s3 = boto3.resource("s3")
-    data = StringIO.StringIO(content)
-    s3.Bucket(s3_bucket).put_object(Key=s3_key, ContentType=file_type,
-                                    Body=data)
-    arn = "arn:aws:s3:::{}:{}".format(s3_bucket, s3_key)
 
-    send(event, context, SUCCESS, physical_resource_id=arn,
-         response_data={"Arn": arn})
+def create_file(event, context):
+    """Create one or more S3 files
 
+    Batches given as a ``Files`` list are uploaded concurrently, with at
+    most ``MaxConcurrency`` uploads in flight. ``MultipartThreshold``
+    and ``PartSize`` (in bytes) tune when and how large ``Source``
+    copies are split into parts. The part copies of all files share one
+    pool of ``MaxConcurrency`` workers.
 
-def delete_file(event, context):
-    """Delete a S3 file"""
-    s3_arn = event["PhysicalResourceId"]
-    bucket, key = s3_arn.split(":")[-2:]
-    s3 = boto3.resource("s3")
-    s3.Bucket(bucket).delete_objects(
+    A ``Prefix`` marks everything below it as owned by the resource, to
+    be removed when it is deleted.
+
+    The response data is a fixed-size summary, as CloudFormation rejects
+    responses over 4096 bytes however many files there are: ``Arn``,
+    the number of files in ``Count``, the digest of their keys in
+    ``KeysDigest`` and in ``Written`` how many were uploaded. Files
+    whose content is unchanged are skipped.
+    The physical resource id only changes with the bucket, so an Update
+    in the same bucket never replaces the resource. It instead deletes
+    the files dropped since the previous properties itself.
+
+    """
+    filecfg = event["ResourceProperties"]
+    s3_bucket = filecfg["Bucket"]
+    files = _file_list(filecfg)
+    max_workers = int(filecfg.get("MaxConcurrency", MAX_CONCURRENCY))
+    threshold = int(filecfg.get("MultipartThreshold", MULTIPART_THRESHOLD))
+    part_size = max(int(filecfg.get("PartSize", PART_SIZE)), MIN_PART_SIZE)
+    physical_id = _physical_id(event, s3_bucket)
+
+    s3 = client("s3")
+    with ThreadPoolExecutor(max_workers=max_workers) as parts, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        wrote = list(executor.map(
+            lambda f: write_file(s3, s3_bucket, f, physical_id, threshold,
+                                 part_size, parts),
+            files
+        ))
+    keys = [f["Key"] for f in files]
+
+    old_filecfg = event.get("OldResourceProperties", {})
+    if event["RequestType"] == "Update" and \
+       old_filecfg.get("Bucket") == s3_bucket:
+        dropped = set(f["Key"] for f in _file_list(old_filecfg)) - set(keys)
+        _delete_owned(s3, s3_bucket, sorted(dropped), physical_id,
+                      max_workers)
+
+    response_data = {
+        "Arn": _files_arn(s3_bucket, keys, filecfg.get("Prefix")),
+        "Count": str(len(keys)),
+        "KeysDigest": _keys_digest(keys),
+        "Written": str(sum(wrote)),
+    }
+    send(event, context, SUCCESS, physical_resource_id=physical_id,
+         response_data=response_data)
+
+
+def _delete_batch(s3, s3_bucket, keys):
+    """Delete up to DELETE_BATCH_SIZE keys in one request"""
+    resp = s3.delete_objects(
+        Bucket=s3_bucket,
         Delete={
-            "Objects": [
-                {"Key": key}
-            ]
+            "Objects": [{"Key": key} for key in keys],
+            "Quiet": True,
         },
     )
-    send(event, context, SUCCESS, response_data={})
+    errors = resp.get("Errors", [])
+    if errors:
+        raise Exception("Failed deleting {} objects, first error: {}".format(
+            len(errors), errors[0]))
+
+
+def _owned(s3, s3_bucket, s3_key, owner):
+    """Whether an object exists and isn't owned by another physical id
+
+    Objects without an owner predate ownership, and belong to whichever
+    resource lists them.
+
+    """
+    head = _existing_object(s3, s3_bucket, s3_key)
+    if head is None:
+        return False
+    return head.get("Metadata", {}).get(OWNER_METADATA, owner) == owner
+
+
+def _delete_owned(s3, s3_bucket, keys, owner, max_workers):
+    """Delete the keys that the owner physical id still owns
+
+    Keys claimed by a replacement resource are left alone.
+
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        owned = list(executor.map(
+            lambda key: _owned(s3, s3_bucket, key, owner), keys))
+    keys = [key for key, mine in zip(keys, owned) if mine]
+    for offset in xrange(0, len(keys), DELETE_BATCH_SIZE):
+        _delete_batch(s3, s3_bucket, keys[offset:offset + DELETE_BATCH_SIZE])
+
+
+def _out_of_time(context):
+    return context.get_remaining_time_in_millis() < TIMEOUT_MARGIN_MS
+
+
+def _delete_prefix(s3, s3_bucket, prefix, context, max_workers):
+    """Delete every object under a prefix
+
+    Keys are listed a page of DELETE_BATCH_SIZE at a time and each page
+    is deleted concurrently with the listing of the next. Returns False
+    if the invocation ran out of time before everything was deleted.
+
+    """
+    paginator = s3.get_paginator("list_objects")
+    pages = paginator.paginate(
+        Bucket=s3_bucket, Prefix=prefix,
+        PaginationConfig={"PageSize": DELETE_BATCH_SIZE},
+    )
+    finished = True
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for page in pages:
+            keys = [obj["Key"] for obj in page.get("Contents", [])]
+            if keys:
+                futures.append(
+                    executor.submit(_delete_batch, s3, s3_bucket, keys))
+            if _out_of_time(context):
+                finished = False
+                break
+        for future in futures:
+            future.result()
+    return finished
+
+
+def _cleaning_up(event):
+    """Whether the Delete is the cleanup after a stack update
+
+    That is, the resource was replaced or dropped from the template
+    rather than the stack deleted.
+
+    """
+    stack = client("cloudformation").describe_stacks(
+        StackName=event["StackId"])["Stacks"][0]
+    return stack["StackStatus"].endswith(CLEANUP_SUFFIX)
+
+
+def _continue_delete(event, context):
+    """Re-invoke this function to carry on with an unfinished delete"""
+    continuation = event.get("Continuation", 0) + 1
+    if continuation > MAX_CONTINUATIONS:
+        raise Exception("Delete still unfinished after {} invocations".format(
+            continuation))
+    print("Out of time, continuing delete in invocation {}".format(
+        continuation))
+    client("lambda").invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps(dict(event, Continuation=continuation)),
+    )
+
+
+def delete_file(event, context):
+    """Delete the S3 file(s) of a resource
+
+    Listed files are removed in as few requests as possible. With a
+    ``Prefix`` every object below it is removed as well, continuing in a
+    new invocation of this function when it would otherwise run past its
+    timeout; the response is only sent once everything is gone.
+
+    The prefix is left alone when the Delete is an update's cleanup, as
+    the resource that replaced this one may be writing below it.
+
+    """
+    physical_id = event["PhysicalResourceId"]
+    filecfg = event.get("ResourceProperties", {})
+    if "Bucket" in filecfg:
+        bucket = filecfg["Bucket"]
+        keys = [f["Key"] for f in _file_list(filecfg)]
+    elif physical_id.startswith("arn:aws:s3:::"):
+        # A plain single file id names its bucket and key
+        bucket, key = physical_id.split(":")[-2:]
+        keys = [key]
+    else:
+        return send(event, context, SUCCESS,
+                    physical_resource_id=physical_id, response_data={})
+    max_workers = int(filecfg.get("MaxConcurrency", MAX_CONCURRENCY))
+
+    s3 = client("s3")
+    if not event.get("Continuation"):
+        _delete_owned(s3, bucket, keys, physical_id, max_workers)
+    prefix = filecfg.get("Prefix")
+    if prefix is not None and not event.get("Continuation") and \
+       _cleaning_up(event):
+        print("Update cleanup, leaving {} in place".format(prefix))
+        prefix = None
+    if prefix is not None and \
+       not _delete_prefix(s3, bucket, prefix, context, max_workers):
+        return _continue_delete(event, context)
+    send(event, context, SUCCESS, physical_resource_id=physical_id,
+         response_data={})
 
 
 HANDLERS = {
@@ -107,8 +484,7 @@ HANDLERS = {
 }
 
 
-def lambda_handler(event, context):
-    handler = HANDLERS.get(event["RequestType"])
+def _handle(handler, event, context):
     try:
         return handler(event, context)
     except:
@@ -116,8 +492,34 @@ def lambda_handler(event, context):
         for err in sys.exc_info():
             msg += "\n{}\n".format(err)
         response_data = {
-            "Error": "{} resource failed: {}".format(event["RequestType"], msg)
+            "Error": "{} resource failed: {}".format(
+                event["RequestType"], msg)[:MAX_ERROR_LENGTH]
         }
         print(response_data)
-        return send(event, context, FAILED, response_data=response_data)
+        # Keep the existing physical id so a failed Update or Delete
+        # isn't mistaken for a replacement
+        return send(event, context, FAILED, response_data=response_data,
+                    physical_resource_id=event.get("PhysicalResourceId"))
         raise
+
+
+def lambda_handler(event, context):
+    handler = HANDLERS.get(event["RequestType"])
+    _timings.response = 0.0
+    _timings.send_attempts = 0
+    started = time.time()
+    try:
+        return _handle(handler, event, context)
+    finally:
+        total = time.time() - started
+        # Structured timing of the S3 work vs. the response delivery
+        print(json.dumps({
+            "timing": "s3writer",
+            "request_type": event["RequestType"],
+            "logical_resource_id": event.get("LogicalResourceId"),
+            "continuation": event.get("Continuation", 0),
+            "s3_ms": int((total - _timings.response) * 1000),
+            "response_ms": int(_timings.response * 1000),
+            "send_attempts": _timings.send_attempts,
+            "total_ms": int(total * 1000),
+        }))
@@ -1,4 +1,9 @@
+import base64
+import gzip
+import hashlib
+import os
 import uuid
+from StringIO import StringIO
 
 import awacs.dynamodb as ddb
 import awacs.elasticache as elasticache
@@ -16,25 +21,43 @@ from awacs.sts import AssumeRole
 from cryptography.fernet import Fernet
 from troposphere import (
     Base64,
+    Equals,
+    FindInMap,
+    GetAZs,
     GetAtt,
+    If,
     Join,
+    Not,
     Parameter,
     Ref,
     Output,
     Tags,
     Template,
 )
+from troposphere.autoscaling import (
+    AutoScalingGroup,
+    LaunchConfiguration,
+    Tag as ASTag,
+)
 from troposphere.awslambda import (
     Code,
     Function,
+    Permission,
     VPCConfig,
 )
 from troposphere.cloudformation import CustomResource
+from troposphere.cloudwatch import MetricDimension
 from troposphere.ec2 import (
     Instance,
+    NetworkInterfaceProperty,
+    PlacementGroup,
     SecurityGroup,
     SecurityGroupRule,
 )
+from troposphere.events import (
+    Rule,
+    Target,
+)
 from troposphere.elasticache import (
     CacheCluster,
     SubnetGroup,
@@ -52,24 +75,139 @@ from troposphere.s3 import (
     Bucket,
 )
 
+from resourcetypes import (
+    DAXCluster,
+    DAXSubnetGroup,
+    DeliveryStream,
+    EnvironmentFunction,
+    LambdaEnvironment,
+    MissingDataAlarm,
+)
+from stackops import (
+    StackDeployer,
+    StackTeardown,
+    format_timings,
+    parse_parameters,
+)
+
 
 @click.group()
 def cli():
     pass
 
 
+def template_options(func):
+    """Options selecting the optional parts of the Push stack template
+
+    Each option is passed on as the CloudFormationBuilder keyword argument
+    of the same name.
+
+    """
+    options = [
+        click.option("--firehose/--no-firehose", "use_firehose",
+                     default=False, help="Include Firehose output"),
+        click.option("--processor/--no-processor", "use_processor",
+                     default=False,
+                     help=("Include Message processing and API, includes "
+                           "firehose")),
+        click.option("--log-transform/--no-log-transform",
+                     "use_log_transform", default=False,
+                     help=("Filter, sample and aggregate logs before "
+                           "delivery, includes native firehose")),
+        click.option("--native-firehose/--no-native-firehose",
+                     "use_native_firehose", default=False,
+                     help=("Declare the Firehose delivery stream natively "
+                           "instead of with a custom resource, includes "
+                           "firehose")),
+        click.option("--dax/--no-dax", "use_dax", default=False,
+                     help="Include a DynamoDB accelerator cluster"),
+        click.option("--vpc/--no-vpc", "use_vpc", default=False,
+                     help="Run the autopush instances in a VPC"),
+        click.option("--rotate-tables/--no-rotate-tables",
+                     "use_table_rotation", default=False,
+                     help="Pre-create and retire rotating message tables"),
+        click.option("--canary/--no-canary", "use_canary", default=False,
+                     help="Include a delivery latency canary"),
+        click.option("--tune-runtime/--no-tune-runtime", "use_runtime_tuning",
+                     default=False,
+                     help="Add PyPy and container parameters per tier"),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def build_template(options):
+    """CloudFormationBuilder for the template options"""
+    try:
+        return CloudFormationBuilder(**options)
+    except ValueError as exc:
+        raise click.UsageError(str(exc))
+
+
 @click.command()
-@click.option("--firehose/--no-firehose", default=False,
-              help="Include Firehose output")
-@click.option("--processor/--no-processor", default=False,
-              help="Include Message processing and API, includes firehose")
-def push(firehose, processor):
-    cb = CloudFormationBuilder(use_firehose=firehose,
-                               use_processor=processor)
+@template_options
+def push(**options):
+    cb = build_template(options)
     print cb.json()
 
 
+@click.command()
+@template_options
+@click.option("--stack-name", "stack_names", multiple=True, required=True,
+              help="Stack to create or update, may be given multiple times")
+@click.option("--parameter", "-p", "parameters", multiple=True,
+              help="Stack parameter as KEY=VALUE, may be given multiple times")
+@click.option("--concurrency", default=4, type=int,
+              help="Maximum number of stacks to operate on at once")
+@click.option("--region", default="us-east-1", help="AWS region")
+@click.option("--endpoint-url", default=None,
+              help="CloudFormation endpoint, for local AWS stand-ins")
+def apply(stack_names, parameters, concurrency, region, endpoint_url,
+          **options):
+    cb = build_template(options)
+    try:
+        params = parse_parameters(parameters)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+    deployer = StackDeployer(cb.template_body(), parameters=params,
+                             concurrency=concurrency, region=region,
+                             endpoint_url=endpoint_url, echo=click.echo)
+    results = deployer.apply(stack_names)
+    for result in results:
+        click.echo(format_timings(result))
+    if not all(result.ok for result in results):
+        raise SystemExit(1)
+
+
+@click.command()
+@click.option("--stack-name", "stack_names", multiple=True, required=True,
+              help="Stack to delete, may be given multiple times")
+@click.option("--concurrency", default=4, type=int,
+              help="Maximum number of stacks to operate on at once")
+@click.option("--region", default="us-east-1", help="AWS region")
+@click.option("--endpoint-url", default=None,
+              help="AWS endpoint, for local AWS stand-ins")
+def teardown(stack_names, concurrency, region, endpoint_url):
+    remover = StackTeardown(concurrency=concurrency, region=region,
+                            endpoint_url=endpoint_url, echo=click.echo)
+    results = remover.teardown(stack_names)
+    for result in results:
+        click.echo(format_timings(result))
+    if not all(result.ok for result in results):
+        raise SystemExit(1)
+
+
+@click.command()
+def loadtest():
+    """Template of load generators for a Push stack's PushServerURL"""
+    print LoadTestBuilder().json()
+
+
 cli.add_command(push)
+cli.add_command(apply)
+cli.add_command(teardown)
+cli.add_command(loadtest)
 
 
 # Common bits
@@ -85,19 +223,119 @@ def allow_tcp(port, from_ip="0.0.0.0/0"):
     )
 
 
+# Per-tier autopush runtime settings: parameter suffix, description, and
+# the docker run argument it sets, empty parameters leave it out
+RUNTIME_SETTINGS = [
+    ("GCNursery",
+     "PyPy GC nursery size, such as 4MB (PYPY_GC_NURSERY)",
+     "-e 'PYPY_GC_NURSERY=%s' "),
+    ("GCMax",
+     "PyPy GC maximum heap size, such as 1.5GB (PYPY_GC_MAX)",
+     "-e 'PYPY_GC_MAX=%s' "),
+    ("GCMajorCollect",
+     "PyPy GC heap growth before a major collection, such as 1.82 "
+     "(PYPY_GC_MAJOR_COLLECT)",
+     "-e 'PYPY_GC_MAJOR_COLLECT=%s' "),
+    ("MemoryLimit",
+     "Container memory limit, such as 1536m",
+     "--memory %s "),
+    ("CPUQuota",
+     "Container CPU time in microseconds per 100000, 100000 per CPU",
+     "--cpu-period 100000 --cpu-quota %s "),
+]
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Shared by the custom resources
+CUSTOM_RESOURCE_PATHS = ["customresources/__init__.py",
+                         "customresources/cfnresponse.py"]
+
+# The Lambdas built from this repo by tools/package_lambdas:
+# name -> (function directory, bundled repo paths, pip requirements)
+# The last websocket-client release that runs on python2.7, for pushtest
+WEBSOCKET_CLIENT = "websocket-client==0.59.0"
+LAMBDA_SOURCES = {
+    "s3writer": ("customresources/s3writer", CUSTOM_RESOURCE_PATHS,
+                 ["futures==3.0.5"]),
+    "enicleanup": ("customresources/enicleanup", CUSTOM_RESOURCE_PATHS,
+                   ["futures==3.0.5"]),
+    "messagetables": ("lambdas/messagetables", [], []),
+    "logtransform": ("lambdas/logtransform", [], []),
+    "canary": ("lambdas/canary", ["pushtest"], [WEBSOCKET_CLIENT]),
+}
+
+
+def source_files(path):
+    """Sorted repo relative paths of the files at path, less compiled ones"""
+    full = os.path.join(ROOT, path)
+    if os.path.isfile(full):
+        return [path]
+    files = []
+    for root, _, names in os.walk(full):
+        for name in names:
+            if not name.endswith((".pyc", ".pyo")):
+                files.append(os.path.relpath(os.path.join(root, name), ROOT))
+    return sorted(files)
+
+
+def lambda_zip_key(name):
+    """S3 key in LambdaCodeBucket of a Lambda built from this repo
+
+    The key carries a digest of the sources and requirements that go in
+    the zip, so a stack update picks up changed code once it's uploaded.
+
+    """
+    function_dir, paths, requirements = LAMBDA_SOURCES[name]
+    digest = hashlib.sha1()
+    for path in [function_dir + "/lambda_function.py"] + paths:
+        for source in source_files(path):
+            digest.update(source.replace(os.sep, "/") + "\0")
+            with open(os.path.join(ROOT, source), "rb") as content:
+                digest.update(content.read())
+    digest.update("\0".join(requirements))
+    return "%s_lambda_%s.zip" % (name, digest.hexdigest()[:12])
+
+
 class CloudFormationBuilder(object):
-    def __init__(self, use_firehose=False, use_processor=False):
+    def __init__(self, use_firehose=False, use_processor=False,
+                 use_dax=False, use_table_rotation=False, use_vpc=False,
+                 use_log_transform=False, use_canary=False,
+                 use_native_firehose=False, use_runtime_tuning=False):
+        if use_dax and not use_vpc:
+            raise ValueError("--dax requires --vpc, the accelerator runs "
+                             "in the autopush VPC")
         self._random_id = str(uuid.uuid4()).replace('-', '')[:12].upper()
         self._template = Template()
         self._template.add_version("2010-09-09")
         desc = "AWS CloudFormation Push Stack"
         if use_processor:
             desc += " - with Firehose Logging + Processor + Push Messages API"
-        elif use_firehose:
+        elif use_firehose or use_log_transform or use_native_firehose:
             desc += " - with Firehose Logging"
+        if use_log_transform:
+            desc += " + Log Reduction"
+        if use_dax:
+            desc += " + DynamoDB Accelerator"
+        if use_table_rotation:
+            desc += " + Message Table Rotation"
+        if use_canary:
+            desc += " + Latency Canary"
+        if use_vpc:
+            desc += " (VPC)"
         self._template.add_description(desc)
-        self.use_firehose = use_firehose or use_processor
+        self.use_firehose = use_firehose or use_processor or \
+            use_log_transform or use_native_firehose
+        # The Firehose custom resource doesn't pass a processing
+        # configuration on
+        self.use_native_firehose = use_native_firehose or use_log_transform
+        self.use_log_transform = use_log_transform
         self.use_processor = use_processor
+        self.use_dax = use_dax
+        self.use_table_rotation = use_table_rotation
+        self.use_vpc = use_vpc
+        self.use_canary = use_canary
+        self.use_runtime_tuning = use_runtime_tuning
         self.add_resource = self._template.add_resource
         self.add_parameter = self._template.add_parameter
 
@@ -113,6 +351,17 @@ class CloudFormationBuilder(object):
             ]
         ))
 
+        if use_processor or use_table_rotation or use_log_transform or \
+           use_canary:
+            self.LambdaCodeBucket = self.add_parameter(Parameter(
+                "LambdaCodeBucket",
+                Type="String",
+                Description=(
+                    "S3 Bucket the Lambda zips were uploaded to by "
+                    "tools/package_lambdas"
+                ),
+            ))
+
         if self.use_processor:
             self.ProcessorLambdaBucket = self.add_parameter(Parameter(
                 "ProcessorLambdaBucket",
@@ -164,6 +413,107 @@ class CloudFormationBuilder(object):
                 ]
             ))
 
+        if self.use_vpc:
+            self.AutopushVPCId = self.add_parameter(Parameter(
+                "AutopushVPCId",
+                Type="AWS::EC2::VPC::Id",
+                Description="VPC to run the autopush instances in"
+            ))
+            self.AutopushSubnetId = self.add_parameter(Parameter(
+                "AutopushSubnetId",
+                Type="AWS::EC2::Subnet::Id",
+                Description=(
+                    "Public subnet to run the autopush instances in, both "
+                    "share it so internal routing stays in one availability "
+                    "zone"
+                ),
+            ))
+            instance_types = [
+                "t2.micro",
+                "c4.large",
+                "c4.xlarge",
+                "c4.2xlarge",
+                "c4.4xlarge",
+                "m4.large",
+                "m4.xlarge",
+                "m4.2xlarge",
+                "r3.large",
+                "r3.xlarge",
+            ]
+            self.AutopushEndpointInstanceType = self.add_parameter(Parameter(
+                "AutopushEndpointInstanceType",
+                Type="String",
+                Default="c4.large",
+                Description=(
+                    "autoendpoint instance type, all but t2 have enhanced "
+                    "networking and can join the placement group"
+                ),
+                AllowedValues=instance_types,
+            ))
+            self.AutopushConnectionInstanceType = self.add_parameter(
+                Parameter(
+                    "AutopushConnectionInstanceType",
+                    Type="String",
+                    Default="c4.large",
+                    Description=(
+                        "autopush instance type, all but t2 have enhanced "
+                        "networking and can join the placement group"
+                    ),
+                    AllowedValues=instance_types,
+                ))
+            self.AutopushUsePlacementGroup = self.add_parameter(Parameter(
+                "AutopushUsePlacementGroup",
+                Type="String",
+                Default="false",
+                Description=(
+                    "Launch the autopush instances in a cluster placement "
+                    "group, requires non-t2 instance types"
+                ),
+                AllowedValues=["true", "false"],
+            ))
+            self._template.add_condition(
+                "UseAutopushPlacementGroup",
+                Equals(Ref(self.AutopushUsePlacementGroup), "true")
+            )
+
+        if self.use_dax:
+            self.DAXNodeType = self.add_parameter(Parameter(
+                "DAXNodeType",
+                Type="String",
+                Default="dax.t2.small",
+                Description="Node type of the DynamoDB accelerator cluster",
+                AllowedValues=[
+                    "dax.t2.small",
+                    "dax.t2.medium",
+                    "dax.r4.large",
+                    "dax.r4.xlarge",
+                    "dax.r4.2xlarge",
+                ]
+            ))
+            self.DAXNodeCount = self.add_parameter(Parameter(
+                "DAXNodeCount",
+                Type="Number",
+                Default="1",
+                Description="Number of DynamoDB accelerator nodes",
+                MinValue=1,
+                MaxValue=10,
+            ))
+            self.AutopushUseDAX = self.add_parameter(Parameter(
+                "AutopushUseDAX",
+                Type="String",
+                Default="false",
+                Description=(
+                    "Create the accelerator and pass it to autopush as "
+                    "--dax_endpoint, only for autopush versions with that "
+                    "option"
+                ),
+                AllowedValues=["true", "false"],
+            ))
+            self._template.add_condition(
+                "UseAutopushDAX",
+                Equals(Ref(self.AutopushUseDAX), "true")
+            )
+
         self.PushCryptoKey = self.add_parameter(Parameter(
             "AutopushCryptoKey",
             Type="String",
@@ -184,24 +534,226 @@ class CloudFormationBuilder(object):
             Description="Autopush DynamoDB Table Prefixes",
         ))
 
+        # Runtime tuning of each autopush tier, empty keeps the defaults
+        self.RuntimeParameters = {}
+        if self.use_runtime_tuning:
+            for tier, program in [("AutopushEndpoint", "autoendpoint"),
+                                  ("AutopushConnection", "autopush")]:
+                self._add_runtime_parameters(tier, program)
+
+        if self.use_table_rotation:
+            self.MessageTableDaysAhead = self.add_parameter(Parameter(
+                "MessageTableDaysAhead",
+                Type="Number",
+                Default="7",
+                Description=(
+                    "Days before the end of the month to create the next "
+                    "month's message table"
+                ),
+                MinValue=1,
+                MaxValue=27,
+            ))
+            self.MessageTableRetentionMonths = self.add_parameter(Parameter(
+                "MessageTableRetentionMonths",
+                Type="Number",
+                Default="3",
+                Description=(
+                    "Months of message tables to keep, including the "
+                    "current one"
+                ),
+                MinValue=2,
+            ))
+
+        if self.use_log_transform:
+            self.LogTransformKeepTypes = self.add_parameter(Parameter(
+                "LogTransformKeepTypes",
+                Type="String",
+                Default="",
+                Description=(
+                    "Comma separated log event types to deliver, empty "
+                    "delivers all types"
+                ),
+            ))
+            self.LogTransformSampleRates = self.add_parameter(Parameter(
+                "LogTransformSampleRates",
+                Type="String",
+                Default="",
+                Description=(
+                    "Comma separated type:rate pairs, events of each type "
+                    "are delivered with the given probability"
+                ),
+            ))
+            self.LogTransformAggregateTypes = self.add_parameter(Parameter(
+                "LogTransformAggregateTypes",
+                Type="String",
+                Default="",
+                Description=(
+                    "Comma separated log event types delivered only as "
+                    "counts per time window and delivery batch"
+                ),
+            ))
+            self.LogTransformWindow = self.add_parameter(Parameter(
+                "LogTransformWindow",
+                Type="Number",
+                Default="60",
+                Description="Seconds per aggregated counter window",
+                MinValue=1,
+            ))
+
+        if self.use_canary:
+            self.CanaryProbeCount = self.add_parameter(Parameter(
+                "CanaryProbeCount",
+                Type="Number",
+                Default="5",
+                Description="Notifications the canary sends per run",
+                MinValue=1,
+                MaxValue=10,
+            ))
+            self.CanaryInterval = self.add_parameter(Parameter(
+                "CanaryInterval",
+                Type="String",
+                Default="5",
+                Description="Minutes between canary runs",
+                AllowedValues=["1", "5", "15"],
+            ))
+            # Alarm periods follow the schedule so every period has a run
+            self._template.add_mapping("CanaryIntervals", {
+                "1": {"Rate": "rate(1 minute)", "Period": "60"},
+                "5": {"Rate": "rate(5 minutes)", "Period": "300"},
+                "15": {"Rate": "rate(15 minutes)", "Period": "900"},
+            })
+            self.CanaryLatencyThreshold = self.add_parameter(Parameter(
+                "CanaryLatencyThreshold",
+                Type="Number",
+                Default="1000",
+                Description=(
+                    "p99 delivery latency in milliseconds to alarm above"
+                ),
+                MinValue=1,
+            ))
+            self.CanarySuccessThreshold = self.add_parameter(Parameter(
+                "CanarySuccessThreshold",
+                Type="Number",
+                Default="100",
+                Description=(
+                    "Percentage of canary notifications delivered to alarm "
+                    "below"
+                ),
+                MinValue=1,
+                MaxValue=100,
+            ))
+            self.CanaryAlarmPeriods = self.add_parameter(Parameter(
+                "CanaryAlarmPeriods",
+                Type="Number",
+                Default="2",
+                Description="Consecutive canary runs breaching to alarm",
+                MinValue=1,
+            ))
+            self.CanaryAlarmTopic = self.add_parameter(Parameter(
+                "CanaryAlarmTopic",
+                Type="String",
+                Default="",
+                Description="SNS topic ARN to notify of alarms, optional",
+            ))
+            self._template.add_condition(
+                "HasCanaryAlarmTopic",
+                Not(Equals(Ref(self.CanaryAlarmTopic), ""))
+            )
+
         if self.use_firehose:
-            self._setup_firehose_custom_resource()
+            if not self.use_native_firehose:
+                self._setup_firehose_custom_resource()
+            if self.use_log_transform:
+                self._add_log_transform()
             self._add_firehose()
 
         self._add_autopush_security_group()
         self._add_autopush_iam_roles()
+        if self.use_dax:
+            self._add_dax_cluster()
         self._add_autopush_servers()
+        if self.use_table_rotation:
+            self._add_message_table_rotation()
+        if self.use_canary:
+            self._add_canary()
 
         if self.use_processor:
             self._add_processor_databases()
             self._setup_s3writer_custom_resource()
+            self._setup_eni_cleanup_custom_resource()
             self._add_processor()
             self._add_push_messages_api()
 
+    def _add_runtime_parameters(self, tier, program):
+        params = self.RuntimeParameters[tier] = {}
+        settings = RUNTIME_SETTINGS + [
+            ("JITParams",
+             "PyPy JIT parameters, such as threshold=1000,trace_limit=8000",
+             None),
+        ]
+        for suffix, description, _ in settings:
+            name = tier + suffix
+            params[suffix] = self.add_parameter(Parameter(
+                name,
+                Type="String",
+                Default="",
+                Description="%s: %s" % (program, description),
+            ))
+            self._template.add_condition(
+                "Has" + name,
+                Not(Equals(Ref(params[suffix]), ""))
+            )
+
+    def _runtime_docker_args(self, tier):
+        """docker run arguments of a tier's non-empty runtime settings"""
+        args = []
+        if tier not in self.RuntimeParameters:
+            return args
+        for suffix, _, arg in RUNTIME_SETTINGS:
+            before, after = arg.split("%s")
+            args.append(If(
+                "Has" + tier + suffix,
+                Join("", [before, Ref(self.RuntimeParameters[tier][suffix]),
+                          after]),
+                "",
+            ))
+        return args
+
+    def _runtime_command(self, tier, program):
+        """The tier's program, run with its JIT parameters if any"""
+        if tier not in self.RuntimeParameters:
+            return "./pypy/bin/%s " % program
+        return If(
+            "Has" + tier + "JITParams",
+            Join("", [
+                "./pypy/bin/pypy --jit ",
+                Ref(self.RuntimeParameters[tier]["JITParams"]),
+                " ./pypy/bin/", program, " ",
+            ]),
+            "./pypy/bin/%s " % program,
+        )
+
+    def _lambda_code(self, name):
+        """Code of a Lambda built from this repo"""
+        return Code(
+            S3Bucket=Ref(self.LambdaCodeBucket),
+            S3Key=lambda_zip_key(name),
+        )
+
     def _add_autopush_security_group(self):
+        # VPC security groups are referenced by id rather than name
+        vpc = {}
+        internal_router = dict(
+            SourceSecurityGroupName=Ref("AutopushInternalRouter"))
+        if self.use_vpc:
+            vpc = dict(VpcId=Ref(self.AutopushVPCId))
+            internal_router = dict(
+                SourceSecurityGroupId=GetAtt("AutopushInternalRouter",
+                                             "GroupId"))
         self.InternalRouterSG = self.add_resource(SecurityGroup(
             "AutopushInternalRouter",
-            GroupDescription="Internal Routing SG"
+            GroupDescription="Internal Routing SG",
+            **vpc
         ))
         self.EndpointSG = self.add_resource(SecurityGroup(
             "AutopushEndpointNode",
@@ -210,6 +762,7 @@ class CloudFormationBuilder(object):
                 allow_tcp(22),
             ],
             GroupDescription="Allow HTTP traffic to autoendpoint node",
+            **vpc
         ))
         self.ConnectionSG = self.add_resource(SecurityGroup(
             "AutopushConnectionNode",
@@ -220,13 +773,134 @@ class CloudFormationBuilder(object):
                     IpProtocol="tcp",
                     FromPort=8081,
                     ToPort=8081,
-                    SourceSecurityGroupName=Ref(self.InternalRouterSG)
+                    **internal_router
                 )
             ],
             GroupDescription=(
                 "Allow Websocket traffic to autopush node"
-            )
+            ),
+            **vpc
+        ))
+
+    def _push_tables_arn(self):
+        return Join("", ["arn:aws:dynamodb:us-east-1:*:table/",
+                         Ref(self.PushTablePrefix),
+                         "_*"])
+
+    def _add_dax_cluster(self):
+        self.DAXServiceRole = self.add_resource(Role(
+            "DAXServiceRole",
+            AssumeRolePolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[AssumeRole],
+                        Principal=Principal("Service", "dax.amazonaws.com")
+                    )
+                ]
+            ),
+            Path="/",
+            Condition="UseAutopushDAX",
         ))
+        self.DAXServicePolicy = self.add_resource(PolicyType(
+            "DAXServicePolicy",
+            PolicyName="DAXServiceRole",
+            PolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            ddb.BatchGetItem,
+                            ddb.BatchWriteItem,
+                            ddb.GetItem,
+                            ddb.PutItem,
+                            ddb.DeleteItem,
+                            ddb.UpdateItem,
+                            ddb.Query,
+                            ddb.Scan,
+                            ddb.DescribeTable,
+                        ],
+                        Resource=[self._push_tables_arn()]
+                    ),
+                ]
+            ),
+            Roles=[Ref(self.DAXServiceRole)],
+            DependsOn="DAXServiceRole",
+            Condition="UseAutopushDAX",
+        ))
+        self.DAXClusterSG = self.add_resource(SecurityGroup(
+            "DAXClusterSG",
+            SecurityGroupIngress=[
+                SecurityGroupRule(
+                    IpProtocol="tcp",
+                    FromPort=8111,
+                    ToPort=8111,
+                    SourceSecurityGroupId=GetAtt(group, "GroupId"),
+                )
+                for group in (self.EndpointSG, self.ConnectionSG)
+            ],
+            GroupDescription="Allow DynamoDB accelerator traffic",
+            VpcId=Ref(self.AutopushVPCId),
+            Condition="UseAutopushDAX",
+        ))
+        # Next to the autopush instances, in their subnet
+        self.DAXSubnetGroup = self.add_resource(DAXSubnetGroup(
+            "DAXSubnetGroup",
+            Description="Subnet group for DynamoDB accelerator",
+            SubnetIds=[Ref(self.AutopushSubnetId)],
+            Condition="UseAutopushDAX",
+        ))
+        self.DAXCluster = self.add_resource(DAXCluster(
+            "DAXCluster",
+            Description="DynamoDB accelerator for the Push router table",
+            IAMRoleARN=GetAtt(self.DAXServiceRole, "Arn"),
+            NodeType=Ref(self.DAXNodeType),
+            ReplicationFactor=Ref(self.DAXNodeCount),
+            SubnetGroupName=Ref(self.DAXSubnetGroup),
+            SecurityGroupIds=[
+                GetAtt(self.DAXClusterSG, "GroupId"),
+            ],
+            DependsOn="DAXServicePolicy",
+            Condition="UseAutopushDAX",
+        ))
+        # Item access through the DynamoDB accelerator
+        self.add_resource(PolicyType(
+            "AutopushDAXPolicy",
+            PolicyName="AutopushDAX",
+            PolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            Action("dax", "BatchGetItem"),
+                            Action("dax", "BatchWriteItem"),
+                            Action("dax", "GetItem"),
+                            Action("dax", "PutItem"),
+                            Action("dax", "DeleteItem"),
+                            Action("dax", "UpdateItem"),
+                            Action("dax", "Query"),
+                            Action("dax", "Scan"),
+                        ],
+                        Resource=[
+                            GetAtt(self.DAXCluster, "Arn"),
+                        ]
+                    ),
+                ]
+            ),
+            Roles=[Ref(self.PushServerRole)],
+            Condition="UseAutopushDAX",
+        ))
+        self._template.add_output([
+            Output(
+                "DAXEndpoint",
+                Description="DynamoDB accelerator discovery endpoint",
+                Value=GetAtt(self.DAXCluster, "ClusterDiscoveryEndpoint"),
+                Condition="UseAutopushDAX",
+            )
+        ])
 
     def _add_autopush_iam_roles(self):
         firehose_extras = []
@@ -274,12 +948,7 @@ class CloudFormationBuilder(object):
                             ddb.Query,
                             ddb.Scan,
                         ],
-                        Resource=[
-                            Join("", ["arn:aws:dynamodb:us-east-1:*:table/",
-                                      Ref(self.PushTablePrefix),
-                                      "_*"]
-                                 )
-                        ]
+                        Resource=[self._push_tables_arn()]
                     ),
                     Statement(
                         Effect=Allow,
@@ -330,7 +999,53 @@ class CloudFormationBuilder(object):
             Type=app_type,
         )
 
+    def _autopush_instance_args(self, node_sg, instance_type):
+        """Instance properties placing an autopush instance on the network
+
+        Outside a VPC the instances use the default t2.micro and security
+        group names. In a VPC they get a public address in the autopush
+        subnet, security group ids, and optionally the placement group.
+        instance_type names the parameter holding the VPC instance type.
+
+        """
+        if not self.use_vpc:
+            return dict(
+                InstanceType="t2.micro",
+                SecurityGroups=[
+                    Ref(node_sg),
+                    Ref(self.InternalRouterSG),
+                ],
+            )
+        return dict(
+            InstanceType=Ref(instance_type),
+            NetworkInterfaces=[
+                NetworkInterfaceProperty(
+                    AssociatePublicIpAddress=True,
+                    DeleteOnTermination=True,
+                    DeviceIndex=0,
+                    GroupSet=[
+                        GetAtt(node_sg, "GroupId"),
+                        GetAtt(self.InternalRouterSG, "GroupId"),
+                    ],
+                    SubnetId=Ref(self.AutopushSubnetId),
+                )
+            ],
+            PlacementGroupName=If(
+                "UseAutopushPlacementGroup",
+                Ref("AutopushPlacementGroup"),
+                Ref("AWS::NoValue"),
+            ),
+        )
+
     def _add_autopush_servers(self):
+        if self.use_vpc:
+            self.add_resource(PlacementGroup(
+                "AutopushPlacementGroup",
+                Strategy="cluster",
+                Condition="UseAutopushPlacementGroup",
+            ))
+        # VPC instances may not get a public DNS name
+        public_name = "PublicIp" if self.use_vpc else "PublicDnsName"
         self.PushServerInstanceProfile = self.add_resource(InstanceProfile(
             "AutopushServerInstanceProfile",
             Path="/",
@@ -348,14 +1063,19 @@ class CloudFormationBuilder(object):
             extras.extend([
                 "--firehose_stream_name ", Ref(self.FirehoseLogstream), " "
             ])
+        if self.use_dax:
+            # Table lookups go through the accelerator
+            extras.append(If(
+                "UseAutopushDAX",
+                Join("", [
+                    "--dax_endpoint ",
+                    GetAtt(self.DAXCluster, "ClusterDiscoveryEndpoint"), " ",
+                ]),
+                "",
+            ))
         self.PushEndpointServerInstance = self.add_resource(Instance(
             "AutopushEndpointInstance",
             ImageId="ami-2c393546",
-            InstanceType="t2.micro",
-            SecurityGroups=[
-                Ref(self.EndpointSG),
-                Ref(self.InternalRouterSG),
-            ],
             KeyName=Ref(self.KeyPair),
             IamInstanceProfile=Ref(self.PushServerInstanceProfile),
             CreationPolicy=CreationPolicy(
@@ -387,20 +1107,19 @@ class CloudFormationBuilder(object):
                 "--name autoendpoint ",
                 "-p 8082:8082 ",
                 "-e 'AWS_DEFAULT_REGION=us-east-1' ",
+                ] + self._runtime_docker_args("AutopushEndpoint") + [
                 "bbangert/autopush:", Ref(self.AutopushVersion), " ",
-                "./pypy/bin/autoendpoint ",
+                self._runtime_command("AutopushEndpoint", "autoendpoint"),
             ] + extras)),
             DependsOn="AutopushServerRolePolicy",
             Tags=self._instance_tags("autopush", "autoendpoint"),
+            **self._autopush_instance_args(
+                self.EndpointSG,
+                "AutopushEndpointInstanceType")
         ))
         self.PushConnectionServerInstance = self.add_resource(Instance(
             "AutopushConnectionInstance",
             ImageId="ami-2c393546",
-            InstanceType="t2.micro",
-            SecurityGroups=[
-                Ref(self.ConnectionSG),
-                Ref(self.InternalRouterSG),
-            ],
             KeyName=Ref(self.KeyPair),
             IamInstanceProfile=Ref(self.PushServerInstanceProfile),
             CreationPolicy=CreationPolicy(
@@ -433,32 +1152,37 @@ class CloudFormationBuilder(object):
                 "-p 8080:8080 ",
                 "-p 8081:8081 ",
                 "-e 'AWS_DEFAULT_REGION=us-east-1' ",
+                ] + self._runtime_docker_args("AutopushConnection") + [
                 "bbangert/autopush:", Ref(self.AutopushVersion), " ",
-                "./pypy/bin/autopush ",
+                self._runtime_command("AutopushConnection", "autopush"),
                 "--router_hostname $private_ipv4 ",
                 "--endpoint_hostname ",
-                GetAtt(self.PushEndpointServerInstance, "PublicDnsName"),
+                GetAtt(self.PushEndpointServerInstance, public_name),
                 " ",
             ] + extras)),
             DependsOn="AutopushServerRolePolicy",
             Tags=self._instance_tags("autopush", "autopush"),
+            **self._autopush_instance_args(
+                self.ConnectionSG,
+                "AutopushConnectionInstanceType")
         ))
+        self.PushServerURL = Join("", [
+            "ws://",
+            GetAtt(self.PushConnectionServerInstance, public_name),
+            ":8080/"
+        ])
         self._template.add_output([
             Output(
                 "PushServerURL",
                 Description="Push Websocket URL",
-                Value=Join("", [
-                    "ws://",
-                    GetAtt(self.PushConnectionServerInstance, "PublicDnsName"),
-                    ":8080/"
-                ])
+                Value=self.PushServerURL,
             )
         ])
 
-    def _setup_firehose_custom_resource(self):
-        # Setup the FirehoseLambda CloudFormation Custom Resource
-        self.FirehoseLambdaCFExecRole = self.add_resource(Role(
-            "FirehoseLambdaCFRole",
+    def _add_message_table_rotation(self):
+        message_prefix = Join("", [Ref(self.PushTablePrefix), "_message"])
+        self.MessageTableRotatorRole = self.add_resource(Role(
+            "MessageTableRotatorRole",
             AssumeRolePolicyDocument=Policy(
                 Version="2012-10-17",
                 Statement=[
@@ -471,9 +1195,9 @@ class CloudFormationBuilder(object):
             ),
             Path="/",
         ))
-        self.FirehoseLambdaPolicy = self.add_resource(PolicyType(
-            "FirehoseCFPolicy",
-            PolicyName="FirehoseLambdaCFRole",
+        self.MessageTableRotatorPolicy = self.add_resource(PolicyType(
+            "MessageTableRotatorPolicy",
+            PolicyName="MessageTableRotatorRole",
             PolicyDocument=Policy(
                 Version="2012-10-17",
                 Statement=[
@@ -491,38 +1215,68 @@ class CloudFormationBuilder(object):
                     Statement(
                         Effect=Allow,
                         Action=[
-                            Action("firehose", "CreateDeliveryStream"),
-                            Action("firehose", "DeleteDeliveryStream"),
-                            Action("firehose", "ListDeliveryStreams"),
-                            Action("firehose", "DescribeDeliveryStream"),
-                            Action("firehose", "UpdateDestination"),
+                            ddb.CreateTable,
+                            ddb.DeleteTable,
+                            ddb.DescribeTable,
+                        ],
+                        Resource=[
+                            Join("", ["arn:aws:dynamodb:us-east-1:*:table/",
+                                      message_prefix, "_*"])
+                        ]
+                    ),
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            ddb.ListTables,
                         ],
                         Resource=["*"]
-                    )
+                    ),
                 ]
             ),
-            Roles=[Ref(self.FirehoseLambdaCFExecRole)],
-            DependsOn="FirehoseLambdaCFRole"
+            Roles=[Ref(self.MessageTableRotatorRole)],
+            DependsOn="MessageTableRotatorRole"
         ))
-        self.FirehoseCFCustomResource = self.add_resource(Function(
-            "FirehoseCustomResource",
+        self.MessageTableRotator = self.add_resource(Function(
+            "MessageTableRotator",
             Description=(
-                "Creates, updates, and deletes Firehose delivery streams"
+                "Pre-creates next month's message table and retires old ones"
             ),
             Runtime="python2.7",
-            Timeout=300,
+            Timeout=60,
             Handler="lambda_function.lambda_handler",
-            Role=GetAtt(self.FirehoseLambdaCFExecRole, "Arn"),
-            Code=Code(
-                S3Bucket="cloudformation-custom-resources",
-                S3Key="firehose_lambda.zip",
-            ),
-            DependsOn="FirehoseCFPolicy"
+            Role=GetAtt(self.MessageTableRotatorRole, "Arn"),
+            Code=self._lambda_code("messagetables"),
+            DependsOn="MessageTableRotatorPolicy"
+        ))
+        self.MessageTableRotationSchedule = self.add_resource(Rule(
+            "MessageTableRotationSchedule",
+            Description="Daily Push message table rotation",
+            ScheduleExpression="rate(1 day)",
+            State="ENABLED",
+            Targets=[
+                Target(
+                    Arn=GetAtt(self.MessageTableRotator, "Arn"),
+                    Id="MessageTableRotator",
+                    Input=Join("", [
+                        '{"table_prefix": "', message_prefix, '", ',
+                        '"days_ahead": ', Ref(self.MessageTableDaysAhead),
+                        ', "retention_months": ',
+                        Ref(self.MessageTableRetentionMonths), '}',
+                    ]),
+                )
+            ],
+        ))
+        self.add_resource(Permission(
+            "MessageTableRotatorPermission",
+            Action="lambda:InvokeFunction",
+            FunctionName=Ref(self.MessageTableRotator),
+            Principal="events.amazonaws.com",
+            SourceArn=GetAtt(self.MessageTableRotationSchedule, "Arn"),
         ))
 
-    def _setup_s3writer_custom_resource(self):
-        self.S3WriterLambdaCFExecRole = self.add_resource(Role(
-            "S3WriterLambdaCFRole",
+    def _add_canary(self):
+        self.CanaryRole = self.add_resource(Role(
+            "PushCanaryRole",
             AssumeRolePolicyDocument=Policy(
                 Version="2012-10-17",
                 Statement=[
@@ -535,9 +1289,9 @@ class CloudFormationBuilder(object):
             ),
             Path="/",
         ))
-        self.S3WriterCFPolicy = self.add_resource(PolicyType(
-            "S3WriterCFPolicy",
-            PolicyName="S3WriterLambdaCFRole",
+        self.CanaryPolicy = self.add_resource(PolicyType(
+            "PushCanaryPolicy",
+            PolicyName="PushCanaryRole",
             PolicyDocument=Policy(
                 Version="2012-10-17",
                 Statement=[
@@ -555,33 +1309,388 @@ class CloudFormationBuilder(object):
                     Statement(
                         Effect=Allow,
                         Action=[
-                            s3.DeleteObject,
-                            s3.ListBucket,
-                            s3.PutObject,
-                            s3.GetObject,
+                            Action("cloudwatch", "PutMetricData"),
                         ],
                         Resource=["*"]
-                    )
+                    ),
                 ]
             ),
-            Roles=[Ref(self.S3WriterLambdaCFExecRole)],
-            DependsOn="S3WriterLambdaCFRole"
+            Roles=[Ref(self.CanaryRole)],
+            DependsOn="PushCanaryRole"
         ))
-        self.S3WriterCFCustomResource = self.add_resource(Function(
-            "S3WriterCustomResource",
+        self.Canary = self.add_resource(Function(
+            "PushCanary",
+            Description="Measures Push notification delivery latency",
+            Runtime="python2.7",
+            # Every notification may wait out its 10 second timeout
+            Timeout=120,
+            Handler="lambda_function.lambda_handler",
+            Role=GetAtt(self.CanaryRole, "Arn"),
+            Code=self._lambda_code("canary"),
+            DependsOn="PushCanaryPolicy"
+        ))
+        self.CanarySchedule = self.add_resource(Rule(
+            "PushCanarySchedule",
+            Description="Push delivery latency canary",
+            ScheduleExpression=FindInMap(
+                "CanaryIntervals", Ref(self.CanaryInterval), "Rate"),
+            State="ENABLED",
+            Targets=[
+                Target(
+                    Arn=GetAtt(self.Canary, "Arn"),
+                    Id="PushCanary",
+                    Input=Join("", [
+                        '{"url": "', self.PushServerURL, '", ',
+                        '"count": ', Ref(self.CanaryProbeCount), ', ',
+                        '"timeout": 10, ',
+                        '"namespace": "Push/Canary", ',
+                        '"stack": "', Ref("AWS::StackName"), '"}',
+                    ]),
+                )
+            ],
+            # The connection node must be up before the first probe
+            DependsOn="AutopushConnectionInstance",
+        ))
+        self.add_resource(Permission(
+            "PushCanaryPermission",
+            Action="lambda:InvokeFunction",
+            FunctionName=Ref(self.Canary),
+            Principal="events.amazonaws.com",
+            SourceArn=GetAtt(self.CanarySchedule, "Arn"),
+        ))
+
+        alarm_actions = If(
+            "HasCanaryAlarmTopic",
+            [Ref(self.CanaryAlarmTopic)],
+            Ref("AWS::NoValue"),
+        )
+        common = dict(
+            Namespace="Push/Canary",
+            Period=FindInMap(
+                "CanaryIntervals", Ref(self.CanaryInterval), "Period"),
+            Dimensions=[
+                MetricDimension(Name="Stack", Value=Ref("AWS::StackName")),
+            ],
+            EvaluationPeriods=Ref(self.CanaryAlarmPeriods),
+            # A canary that can't publish is as bad as a failing one
+            TreatMissingData="breaching",
+            AlarmActions=alarm_actions,
+            OKActions=alarm_actions,
+        )
+        self.add_resource(MissingDataAlarm(
+            "PushCanaryLatencyAlarm",
+            AlarmDescription="Push p99 delivery latency above threshold",
+            MetricName="DeliveryLatencyP99",
+            Statistic="Maximum",
+            ComparisonOperator="GreaterThanThreshold",
+            Threshold=Ref(self.CanaryLatencyThreshold),
+            **common
+        ))
+        self.add_resource(MissingDataAlarm(
+            "PushCanarySuccessAlarm",
+            AlarmDescription="Push notifications failing to deliver",
+            MetricName="SuccessRate",
+            Statistic="Minimum",
+            ComparisonOperator="LessThanThreshold",
+            Threshold=Ref(self.CanarySuccessThreshold),
+            **common
+        ))
+
+    def _setup_firehose_custom_resource(self):
+        # Setup the FirehoseLambda CloudFormation Custom Resource
+        self.FirehoseLambdaCFExecRole = self.add_resource(Role(
+            "FirehoseLambdaCFRole",
+            AssumeRolePolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[AssumeRole],
+                        Principal=Principal("Service", "lambda.amazonaws.com")
+                    )
+                ]
+            ),
+            Path="/",
+        ))
+        self.FirehoseLambdaPolicy = self.add_resource(PolicyType(
+            "FirehoseCFPolicy",
+            PolicyName="FirehoseLambdaCFRole",
+            PolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            Action("logs", "CreateLogGroup"),
+                            Action("logs", "CreateLogStream"),
+                            Action("logs", "PutLogEvents"),
+                        ],
+                        Resource=[
+                            "arn:aws:logs:*:*:*"
+                        ]
+                    ),
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            Action("firehose", "CreateDeliveryStream"),
+                            Action("firehose", "DeleteDeliveryStream"),
+                            Action("firehose", "ListDeliveryStreams"),
+                            Action("firehose", "DescribeDeliveryStream"),
+                            Action("firehose", "UpdateDestination"),
+                        ],
+                        Resource=["*"]
+                    )
+                ]
+            ),
+            Roles=[Ref(self.FirehoseLambdaCFExecRole)],
+            DependsOn="FirehoseLambdaCFRole"
+        ))
+        self.FirehoseCFCustomResource = self.add_resource(Function(
+            "FirehoseCustomResource",
             Description=(
-                "Creates, updates, and deletes S3 Files with custom content"
+                "Creates, updates, and deletes Firehose delivery streams"
             ),
             Runtime="python2.7",
             Timeout=300,
             Handler="lambda_function.lambda_handler",
-            Role=GetAtt(self.S3WriterLambdaCFExecRole, "Arn"),
+            Role=GetAtt(self.FirehoseLambdaCFExecRole, "Arn"),
             Code=Code(
                 S3Bucket="cloudformation-custom-resources",
-                S3Key="s3writer_lambda.zip",
+                S3Key="firehose_lambda.zip",
+            ),
+            DependsOn="FirehoseCFPolicy"
+        ))
+
+    def _setup_s3writer_custom_resource(self):
+        self.S3WriterLambdaCFExecRole = self.add_resource(Role(
+            "S3WriterLambdaCFRole",
+            AssumeRolePolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[AssumeRole],
+                        Principal=Principal("Service", "lambda.amazonaws.com")
+                    )
+                ]
             ),
+            Path="/",
+        ))
+        self.S3WriterCFPolicy = self.add_resource(PolicyType(
+            "S3WriterCFPolicy",
+            PolicyName="S3WriterLambdaCFRole",
+            PolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            Action("logs", "CreateLogGroup"),
+                            Action("logs", "CreateLogStream"),
+                            Action("logs", "PutLogEvents"),
+                        ],
+                        Resource=[
+                            "arn:aws:logs:*:*:*"
+                        ]
+                    ),
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            s3.AbortMultipartUpload,
+                            s3.DeleteObject,
+                            s3.ListBucket,
+                            s3.ListMultipartUploadParts,
+                            s3.PutObject,
+                            s3.GetObject,
+                        ],
+                        Resource=["*"]
+                    ),
+                    # Prefixes are kept when a Delete is an update's
+                    # cleanup
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            Action("cloudformation", "DescribeStacks"),
+                        ],
+                        Resource=[Ref("AWS::StackId")]
+                    ),
+                ]
+            ),
+            Roles=[Ref(self.S3WriterLambdaCFExecRole)],
+            DependsOn="S3WriterLambdaCFRole"
+        ))
+        self.S3WriterCFCustomResource = self.add_resource(Function(
+            "S3WriterCustomResource",
+            Description=(
+                "Creates, updates, and deletes S3 Files with custom content"
+            ),
+            Runtime="python2.7",
+            Timeout=300,
+            Handler="lambda_function.lambda_handler",
+            Role=GetAtt(self.S3WriterLambdaCFExecRole, "Arn"),
+            Code=self._lambda_code("s3writer"),
             DependsOn="S3WriterCFPolicy"
         ))
+        # Prefix deletes continue in a new invocation of the function
+        # when they run out of time. Kept apart from S3WriterCFPolicy,
+        # which the function depends on.
+        self.S3WriterInvokePolicy = self.add_resource(PolicyType(
+            "S3WriterInvokePolicy",
+            PolicyName="S3WriterInvokeSelf",
+            PolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            Action("lambda", "InvokeFunction"),
+                        ],
+                        Resource=[
+                            GetAtt(self.S3WriterCFCustomResource, "Arn")
+                        ]
+                    ),
+                ]
+            ),
+            Roles=[Ref(self.S3WriterLambdaCFExecRole)],
+        ))
+
+    def _setup_eni_cleanup_custom_resource(self):
+        self.ENICleanupLambdaCFExecRole = self.add_resource(Role(
+            "ENICleanupLambdaCFRole",
+            AssumeRolePolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[AssumeRole],
+                        Principal=Principal("Service", "lambda.amazonaws.com")
+                    )
+                ]
+            ),
+            Path="/",
+        ))
+        self.ENICleanupCFPolicy = self.add_resource(PolicyType(
+            "ENICleanupCFPolicy",
+            PolicyName="ENICleanupLambdaCFRole",
+            PolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            Action("logs", "CreateLogGroup"),
+                            Action("logs", "CreateLogStream"),
+                            Action("logs", "PutLogEvents"),
+                        ],
+                        Resource=[
+                            "arn:aws:logs:*:*:*"
+                        ]
+                    ),
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            ec2.DescribeNetworkInterfaces,
+                            ec2.DetachNetworkInterface,
+                            ec2.DeleteNetworkInterface,
+                        ],
+                        Resource=["*"]
+                    ),
+                ]
+            ),
+            Roles=[Ref(self.ENICleanupLambdaCFExecRole)],
+            DependsOn="ENICleanupLambdaCFRole"
+        ))
+        self.ENICleanupCFCustomResource = self.add_resource(Function(
+            "ENICleanupCustomResource",
+            Description=(
+                "Deletes Lambda VPC network interfaces on stack deletion"
+            ),
+            Runtime="python2.7",
+            Timeout=300,
+            Handler="lambda_function.lambda_handler",
+            Role=GetAtt(self.ENICleanupLambdaCFExecRole, "Arn"),
+            Code=self._lambda_code("enicleanup"),
+            DependsOn="ENICleanupCFPolicy"
+        ))
+        # Cleanups continue in a new invocation of the function when
+        # they run out of time
+        self.ENICleanupInvokePolicy = self.add_resource(PolicyType(
+            "ENICleanupInvokePolicy",
+            PolicyName="ENICleanupInvokeSelf",
+            PolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            Action("lambda", "InvokeFunction"),
+                        ],
+                        Resource=[
+                            GetAtt(self.ENICleanupCFCustomResource, "Arn")
+                        ]
+                    ),
+                ]
+            ),
+            Roles=[Ref(self.ENICleanupLambdaCFExecRole)],
+        ))
+
+    def _add_log_transform(self):
+        self.LogTransformRole = self.add_resource(Role(
+            "LogTransformRole",
+            AssumeRolePolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[AssumeRole],
+                        Principal=Principal("Service", "lambda.amazonaws.com")
+                    )
+                ]
+            ),
+            Path="/",
+        ))
+        self.LogTransformPolicy = self.add_resource(PolicyType(
+            "LogTransformPolicy",
+            PolicyName="LogTransformRole",
+            PolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[
+                            Action("logs", "CreateLogGroup"),
+                            Action("logs", "CreateLogStream"),
+                            Action("logs", "PutLogEvents"),
+                        ],
+                        Resource=[
+                            "arn:aws:logs:*:*:*"
+                        ]
+                    ),
+                ]
+            ),
+            Roles=[Ref(self.LogTransformRole)],
+            DependsOn="LogTransformRole"
+        ))
+        self.LogTransformLambda = self.add_resource(EnvironmentFunction(
+            "LogTransformLambda",
+            Description=(
+                "Filters, samples and aggregates autopush log records"
+            ),
+            Runtime="python2.7",
+            Timeout=60,
+            Handler="lambda_function.lambda_handler",
+            Role=GetAtt(self.LogTransformRole, "Arn"),
+            Code=self._lambda_code("logtransform"),
+            Environment=LambdaEnvironment(
+                Variables=dict(
+                    KEEP_TYPES=Ref(self.LogTransformKeepTypes),
+                    SAMPLE_RATES=Ref(self.LogTransformSampleRates),
+                    AGGREGATE_TYPES=Ref(self.LogTransformAggregateTypes),
+                    AGGREGATE_WINDOW=Ref(self.LogTransformWindow),
+                ),
+            ),
+            DependsOn="LogTransformPolicy"
+        ))
 
     def _add_firehose(self):
         self.FirehoseLoggingBucket = self.add_resource(Bucket(
@@ -636,24 +1745,75 @@ class CloudFormationBuilder(object):
             ),
             Roles=[Ref(self.FirehoseLoggingRole)]
         ))
-        self.FirehoseLogstream = self.add_resource(CustomResource(
-            "FirehoseLogStream",
-            ServiceToken=GetAtt(self.FirehoseCFCustomResource, "Arn"),
-            S3DestinationConfiguration=dict(
-                RoleARN=GetAtt(self.FirehoseLoggingRole, "Arn"),
-                BucketARN=Join("", [
-                    "arn:aws:s3:::",
-                    Ref(self.FirehoseLoggingBucket),
-                ]),
-                BufferingHints=dict(
-                    SizeInMBs=5,
-                    IntervalInSeconds=60,
-                )
-            ),
-            DependsOn=[
-                "FirehosePolicy"
-            ]
-        ))
+        destination = dict(
+            RoleARN=GetAtt(self.FirehoseLoggingRole, "Arn"),
+            BucketARN=Join("", [
+                "arn:aws:s3:::",
+                Ref(self.FirehoseLoggingBucket),
+            ]),
+            BufferingHints=dict(
+                SizeInMBs=5,
+                IntervalInSeconds=60,
+            )
+        )
+        if self.use_log_transform:
+            # Records pass through the transform Lambda before delivery
+            destination["ProcessingConfiguration"] = dict(
+                Enabled=True,
+                Processors=[
+                    dict(
+                        Type="Lambda",
+                        Parameters=[
+                            dict(
+                                ParameterName="LambdaArn",
+                                ParameterValue=GetAtt(
+                                    self.LogTransformLambda, "Arn"),
+                            ),
+                        ],
+                    ),
+                ],
+            )
+            self.add_resource(PolicyType(
+                "FirehoseTransformPolicy",
+                PolicyName="FirehoseTransform",
+                PolicyDocument=Policy(
+                    Version="2012-10-17",
+                    Statement=[
+                        Statement(
+                            Effect=Allow,
+                            Action=[
+                                Action("lambda", "InvokeFunction"),
+                                Action("lambda", "GetFunctionConfiguration"),
+                            ],
+                            Resource=[
+                                GetAtt(self.LogTransformLambda, "Arn"),
+                            ]
+                        ),
+                    ]
+                ),
+                Roles=[Ref(self.FirehoseLoggingRole)]
+            ))
+            destination_config = dict(
+                ExtendedS3DestinationConfiguration=destination)
+            depends_on = ["FirehosePolicy", "FirehoseTransformPolicy"]
+        else:
+            destination_config = dict(S3DestinationConfiguration=destination)
+            depends_on = ["FirehosePolicy"]
+        if self.use_native_firehose:
+            # Declared directly, CloudFormation requires the compression
+            destination["CompressionFormat"] = "UNCOMPRESSED"
+            self.FirehoseLogstream = self.add_resource(DeliveryStream(
+                "FirehoseLogStream",
+                DependsOn=depends_on,
+                **destination_config
+            ))
+        else:
+            self.FirehoseLogstream = self.add_resource(CustomResource(
+                "FirehoseLogStream",
+                ServiceToken=GetAtt(self.FirehoseCFCustomResource, "Arn"),
+                DependsOn=depends_on,
+                **destination_config
+            ))
         self._template.add_output([
             Output(
                 "FirehoseLoggingBucket",
@@ -797,7 +1957,20 @@ class CloudFormationBuilder(object):
                 file_type="json",
             ),
             DependsOn=[
-                "S3WriterCustomResource"
+                "S3WriterCustomResource",
+                "S3WriterInvokePolicy",
+            ]
+        ))
+        # Deleted after ProcessorLambda and before LambdaProcessorSG, to
+        # clear the network interfaces the function leaves behind
+        self.ProcessorENICleanup = self.add_resource(CustomResource(
+            "ProcessorENICleanup",
+            ServiceToken=GetAtt(self.ENICleanupCFCustomResource, "Arn"),
+            SecurityGroupIds=[Ref(self.LambdaProcessorSG)],
+            DependsOn=[
+                "ENICleanupCustomResource",
+                "ENICleanupInvokePolicy",
+                "LambdaProcessorSG",
             ]
         ))
         self.ProcessorLambda = self.add_resource(Function(
@@ -822,6 +1995,7 @@ class CloudFormationBuilder(object):
             DependsOn=[
                 "ProcessorExecRole",
                 "ProcessorS3Settings",
+                "ProcessorENICleanup",
             ]
         ))
 
@@ -925,6 +2099,218 @@ class CloudFormationBuilder(object):
     def json(self):
         return self._template.to_json()
 
+    def template_body(self):
+        """Compact JSON of the template, for the API's TemplateBody"""
+        return self._template.to_json(indent=None, separators=(',', ':'))
+
+
+class LoadTestBuilder(object):
+    """Companion stack of load generators for an existing Push stack
+
+    Each generator runs ``pushtest.client`` in a python container against
+    the Push stack's websocket URL, and writes its results to the stack's
+    bucket keyed by instance id. The pushtest package is embedded in the
+    UserData and its dependencies installed with pip, so generators need
+    nothing but Docker Hub and PyPI.
+
+    """
+    def __init__(self):
+        self._template = Template()
+        self._template.add_version("2010-09-09")
+        self._template.add_description("AWS CloudFormation Push Load Test")
+        self.add_resource = self._template.add_resource
+        self.add_parameter = self._template.add_parameter
+
+        self.PushServerURL = self.add_parameter(Parameter(
+            "PushServerURL",
+            Type="String",
+            Description="PushServerURL output of the Push stack under test",
+            AllowedPattern="wss?://.+",
+        ))
+        self.GeneratorCount = self.add_parameter(Parameter(
+            "LoadGeneratorCount",
+            Type="Number",
+            Default="2",
+            Description="Number of load generator instances",
+            MinValue=1,
+            MaxValue=100,
+        ))
+        self.GeneratorInstanceType = self.add_parameter(Parameter(
+            "LoadGeneratorInstanceType",
+            Type="String",
+            Default="c4.large",
+            Description="Load generator instance type",
+            AllowedValues=[
+                "t2.micro",
+                "t2.medium",
+                "c4.large",
+                "c4.xlarge",
+                "c4.2xlarge",
+            ]
+        ))
+        self.ConnectionsPerGenerator = self.add_parameter(Parameter(
+            "ConnectionsPerGenerator",
+            Type="Number",
+            Default="100",
+            Description="Websocket connections opened by each generator",
+            MinValue=1,
+        ))
+        self.NotificationsPerSecond = self.add_parameter(Parameter(
+            "NotificationsPerSecond",
+            Type="Number",
+            Default="50",
+            Description=(
+                "Notifications sent per second by each generator, spread "
+                "over its connections"
+            ),
+            MinValue=1,
+        ))
+        self.TestDuration = self.add_parameter(Parameter(
+            "TestDuration",
+            Type="Number",
+            Default="300",
+            Description="Seconds to send notifications for",
+            MinValue=1,
+        ))
+        self.KeyPair = self.add_parameter(Parameter(
+            "LoadGeneratorSSHKeyPair",
+            Type="AWS::EC2::KeyPair::KeyName",
+            Description="Name of an EC2 KeyPair to enable SSH access."
+        ))
+
+        self._add_results_bucket()
+        self._add_generators()
+
+    def _add_results_bucket(self):
+        self.ResultsBucket = self.add_resource(Bucket(
+            "LoadTestResults",
+            DeletionPolicy="Retain",
+        ))
+        self.GeneratorRole = self.add_resource(Role(
+            "LoadGeneratorRole",
+            AssumeRolePolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Principal=Principal("Service", "ec2.amazonaws.com"),
+                        Action=[AssumeRole],
+                    )
+                ]
+            ),
+            Path="/",
+        ))
+        self.add_resource(PolicyType(
+            "LoadGeneratorRolePolicy",
+            PolicyName="LoadGeneratorRole",
+            PolicyDocument=Policy(
+                Version="2012-10-17",
+                Statement=[
+                    Statement(
+                        Effect=Allow,
+                        Action=[s3.PutObject],
+                        Resource=[
+                            Join("", ["arn:aws:s3:::",
+                                      Ref(self.ResultsBucket), "/*"]),
+                        ]
+                    ),
+                ]
+            ),
+            Roles=[Ref(self.GeneratorRole)]
+        ))
+        self._template.add_output([
+            Output(
+                "LoadTestResultsBucket",
+                Description="Bucket the load generators write results to",
+                Value=Ref(self.ResultsBucket),
+            )
+        ])
+
+    def _pushtest_files(self):
+        """cloud-config write_files entries for the pushtest package"""
+        package = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "pushtest")
+        lines = ["write_files:\n"]
+        for name in ["__init__.py", "client.py", "protocol.py"]:
+            buf = StringIO()
+            with open(os.path.join(package, name)) as source:
+                with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as out:
+                    out.write(source.read())
+            lines.extend([
+                "  - path: /home/core/pushtest/pushtest/%s\n" % name,
+                "    encoding: gzip+base64\n",
+                "    content: %s\n" % base64.b64encode(buf.getvalue()),
+            ])
+        return lines
+
+    def _add_generators(self):
+        self.GeneratorSG = self.add_resource(SecurityGroup(
+            "LoadGeneratorSG",
+            GroupDescription="Load generator SSH access",
+            SecurityGroupIngress=[allow_tcp(22)],
+        ))
+        self.GeneratorInstanceProfile = self.add_resource(InstanceProfile(
+            "LoadGeneratorInstanceProfile",
+            Path="/",
+            Roles=[Ref(self.GeneratorRole)]
+        ))
+        self.GeneratorLaunchConfig = self.add_resource(LaunchConfiguration(
+            "LoadGeneratorLaunchConfig",
+            ImageId="ami-2c393546",
+            InstanceType=Ref(self.GeneratorInstanceType),
+            KeyName=Ref(self.KeyPair),
+            IamInstanceProfile=Ref(self.GeneratorInstanceProfile),
+            SecurityGroups=[Ref(self.GeneratorSG)],
+            UserData=Base64(Join("", [
+                "#cloud-config\n\n",
+                ] + self._pushtest_files() + [
+                "coreos:\n",
+                "  units:\n",
+                "    - name: 'pushtest.service'\n",
+                "      command: 'start'\n",
+                "      content: |\n",
+                "        [Unit]\n",
+                "        Description=Push load generator\n",
+                "        After=docker.service\n",
+                "        \n",
+                "        [Service]\n",
+                "        Type=oneshot\n",
+                "        TimeoutStartSec=0\n",
+                "        ExecStartPre=/usr/bin/docker pull python:2.7\n",
+                "        ExecStart=/usr/bin/docker run --rm ",
+                "--name pushtest ",
+                "-v /home/core/pushtest:/pushtest ",
+                "-w /pushtest ",
+                "python:2.7 ",
+                "sh -c 'pip install click boto3 ", WEBSOCKET_CLIENT, " && ",
+                "python -m pushtest.client ",
+                "--url ", Ref(self.PushServerURL), " ",
+                "--connections ", Ref(self.ConnectionsPerGenerator), " ",
+                "--rate ", Ref(self.NotificationsPerSecond), " ",
+                "--duration ", Ref(self.TestDuration), " ",
+                "--results-bucket ", Ref(self.ResultsBucket), " ",
+                "--results-prefix ", Ref("AWS::StackName"), "/'\n",
+            ])),
+            DependsOn="LoadGeneratorRolePolicy",
+        ))
+        self.add_resource(AutoScalingGroup(
+            "LoadGeneratorGroup",
+            AvailabilityZones=GetAZs(""),
+            LaunchConfigurationName=Ref(self.GeneratorLaunchConfig),
+            DesiredCapacity=Ref(self.GeneratorCount),
+            MinSize=Ref(self.GeneratorCount),
+            MaxSize=Ref(self.GeneratorCount),
+            Tags=[
+                ASTag("App", "pushtest", True),
+                ASTag("Name", Join("", [Ref("AWS::StackName"),
+                                        "-loadgenerator"]), True),
+                ASTag("Stack", Ref("AWS::StackName"), True),
+            ],
+        ))
+
+    def json(self):
+        return self._template.to_json()
+
 
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,132 @@
+"""Lambda Push delivery latency canary
+
+Measures end-to-end notification delivery: the time from POSTing to a
+push endpoint until the notification arrives on the websocket. Each run
+connects to the connection tier, registers a channel, sends ``count``
+notifications through its endpoint one at a time, unregisters the
+channel, and publishes to CloudWatch:
+
+- ``DeliveryLatencyP50`` / ``DeliveryLatencyP99`` in milliseconds, when
+  any notification was delivered
+- ``SuccessRate``, the percentage of notifications delivered in time
+
+The scheduled event is expected to carry:
+
+    {
+        "url": "<PushServerURL>",
+        "count": 5,
+        "timeout": 10,
+        "namespace": "Push/Canary",
+        "stack": "<stack name>"
+    }
+
+The zip includes the ``pushtest`` package for the protocol client, and
+``websocket-client`` for its websocket.
+
+"""
+from __future__ import print_function
+
+import socket
+import time
+import urllib2
+
+import boto3
+import websocket
+
+from pushtest.protocol import PushClient, PushError
+
+
+DEFAULT_COUNT = 5
+DEFAULT_TIMEOUT = 10
+DEFAULT_NAMESPACE = "Push/Canary"
+
+PROBE_ERRORS = (PushError, websocket.WebSocketException, socket.error,
+                urllib2.URLError, ValueError, KeyError)
+
+
+def _count_error(result, exc):
+    name = type(exc).__name__
+    result["errors"][name] = result["errors"].get(name, 0) + 1
+
+
+def probe(url, count=DEFAULT_COUNT, timeout=DEFAULT_TIMEOUT):
+    """Send count notifications through Push, returns the outcome
+
+    A failed notification closes the connection, the next one reconnects
+    with the same uaid and channel. The channel is unregistered at the
+    end, so probes don't leave registrations behind.
+
+    """
+    result = {"attempts": count, "latencies": [], "errors": {}}
+    client = None
+    uaid = channel_id = endpoint = None
+    for _ in range(count):
+        try:
+            if client is None:
+                client = PushClient(url, timeout, uaid=uaid)
+                client.connect()
+                uaid = client.uaid
+                channel_id, endpoint = client.register(channel_id)
+            started = time.time()
+            client.notify(endpoint)
+            client.receive(channel_id)
+            result["latencies"].append((time.time() - started) * 1000)
+        except PROBE_ERRORS as exc:
+            _count_error(result, exc)
+            if client is not None:
+                client.close()
+                client = None
+    if channel_id is not None:
+        try:
+            if client is None:
+                client = PushClient(url, timeout, uaid=uaid)
+                client.connect()
+            client.unregister(channel_id)
+        except PROBE_ERRORS as exc:
+            _count_error(result, exc)
+    if client is not None:
+        client.close()
+    return result
+
+
+def _percentile(ordered, pct):
+    index = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def metric_data(result, stack):
+    """CloudWatch MetricData for a probe result"""
+    dimensions = [{"Name": "Stack", "Value": stack}]
+    latencies = sorted(result["latencies"])
+    metrics = [{
+        "MetricName": "SuccessRate",
+        "Dimensions": dimensions,
+        "Unit": "Percent",
+        "Value": 100.0 * len(latencies) / result["attempts"],
+    }]
+    if latencies:
+        for name, pct in [("DeliveryLatencyP50", 50),
+                          ("DeliveryLatencyP99", 99)]:
+            metrics.append({
+                "MetricName": name,
+                "Dimensions": dimensions,
+                "Unit": "Milliseconds",
+                "Value": _percentile(latencies, pct),
+            })
+    return metrics
+
+
+def lambda_handler(event, context):
+    result = probe(
+        event["url"],
+        count=int(event.get("count", DEFAULT_COUNT)),
+        timeout=int(event.get("timeout", DEFAULT_TIMEOUT)),
+    )
+    metrics = metric_data(result, event["stack"])
+    boto3.client("cloudwatch").put_metric_data(
+        Namespace=event.get("namespace", DEFAULT_NAMESPACE),
+        MetricData=metrics,
+    )
+    print("Delivered {} of {}, errors: {}".format(
+        len(result["latencies"]), result["attempts"], result["errors"]))
+    return {metric["MetricName"]: metric["Value"] for metric in metrics}
@@ -0,0 +1,119 @@
+"""Lambda Firehose record transformation for autopush logs
+
+Reduces the autopush log records delivered to S3 before they are
+written:
+
+- Records whose event type isn't in ``KEEP_TYPES`` are dropped.
+- Event types listed in ``SAMPLE_RATES`` (``type:rate,...``) are kept
+  with the given probability, and tagged with the ``SampleRate`` they
+  were kept at so counts can be scaled back up.
+- Event types in ``AGGREGATE_TYPES`` are replaced by one counter record
+  per type and ``AGGREGATE_WINDOW`` second window within each batch of
+  records Firehose hands to an invocation. A window spanning several
+  batches gets a counter from each, to be summed downstream.
+
+Settings come from the function's environment. Empty settings disable
+their stage, so with no settings every record passes through unchanged.
+Records that aren't JSON always pass through unchanged.
+
+"""
+from __future__ import print_function
+
+import base64
+import json
+import os
+import random
+
+
+OK = "Ok"
+DROPPED = "Dropped"
+
+
+def _list(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+class Settings(object):
+    def __init__(self, environ):
+        self.type_field = environ.get("TYPE_FIELD", "Type")
+        self.timestamp_field = environ.get("TIMESTAMP_FIELD", "Timestamp")
+        self.keep_types = set(_list(environ.get("KEEP_TYPES", "")))
+        self.sample_rates = {}
+        for item in _list(environ.get("SAMPLE_RATES", "")):
+            event_type, rate = item.rsplit(":", 1)
+            self.sample_rates[event_type] = float(rate)
+        self.aggregate_types = set(_list(environ.get("AGGREGATE_TYPES", "")))
+        self.window = int(environ.get("AGGREGATE_WINDOW", "60"))
+
+
+def _seconds(timestamp):
+    """Epoch seconds from a timestamp in seconds, ms or ns"""
+    timestamp = float(timestamp)
+    if timestamp > 1e14:
+        return timestamp / 1e9
+    if timestamp > 1e11:
+        return timestamp / 1e3
+    return timestamp
+
+
+def _encode(entry):
+    return base64.b64encode(json.dumps(entry) + "\n")
+
+
+def transform(records, settings, rand=random.random):
+    """Returns the Firehose transformation results for records
+
+    Every input record gets exactly one result. Counters replace the data
+    of the first record of their group, the rest of the group is dropped.
+
+    """
+    results = []
+    # (type, window start) -> [result, count]
+    counters = {}
+    for record in records:
+        result = {"recordId": record["recordId"], "result": OK,
+                  "data": record["data"]}
+        results.append(result)
+        try:
+            entry = json.loads(base64.b64decode(record["data"]))
+            event_type = entry.get(settings.type_field)
+        except (ValueError, TypeError, AttributeError):
+            continue
+
+        if settings.keep_types and event_type not in settings.keep_types:
+            result["result"] = DROPPED
+        elif event_type in settings.aggregate_types:
+            timestamp = entry.get(settings.timestamp_field) or \
+                record.get("approximateArrivalTimestamp", 0)
+            start = int(_seconds(timestamp)) // settings.window * \
+                settings.window
+            counter = counters.get((event_type, start))
+            if counter is None:
+                counters[(event_type, start)] = [result, 1]
+            else:
+                counter[1] += 1
+                result["result"] = DROPPED
+        elif event_type in settings.sample_rates:
+            rate = settings.sample_rates[event_type]
+            if rand() < rate:
+                entry["SampleRate"] = rate
+                result["data"] = _encode(entry)
+            else:
+                result["result"] = DROPPED
+
+    for (event_type, start), (result, count) in counters.items():
+        result["data"] = _encode({
+            settings.type_field: event_type + ".count",
+            settings.timestamp_field: start,
+            "Window": settings.window,
+            "Count": count,
+        })
+    return results
+
+
+def lambda_handler(event, context):
+    settings = Settings(os.environ)
+    results = transform(event["records"], settings)
+    kept = sum(1 for result in results if result["result"] == OK)
+    print("Kept {} of {} records".format(kept, len(results)))
+    return {"records": results}
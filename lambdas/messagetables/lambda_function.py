@@ -0,0 +1,146 @@
+"""Lambda Push message table rotation
+
+autopush keeps messages in month-rotated DynamoDB tables named
+``<message_tablename>_YYYY_M``, without zero padding the month, and
+creates next month's table itself at rollover, with default capacity,
+right when it's needed. Run daily, this creates next month's table ahead
+of time with the capacity of the current one and deletes tables older
+than the retention window.
+
+The scheduled event is expected to carry:
+
+    {
+        "table_prefix": "<PushTablePrefix>_message",
+        "days_ahead": 7,
+        "retention_months": 3
+    }
+
+"""
+from __future__ import print_function
+
+import datetime
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+DEFAULT_DAYS_AHEAD = 7
+# autopush still reads last month's table, never retire it
+MIN_RETENTION_MONTHS = 2
+
+
+def table_name(prefix, year, month):
+    """Name of a rotating table, as autopush's make_rotating_tablename"""
+    return "{}_{}_{}".format(prefix, year, month)
+
+
+def add_months(year, month, delta):
+    """Returns (year, month) offset by delta months"""
+    index = year * 12 + month - 1 + delta
+    return index // 12, index % 12 + 1
+
+
+def parse_table_month(prefix, name):
+    """Returns the (year, month) of a rotating table, or None"""
+    if not name.startswith(prefix + "_"):
+        return None
+    parts = name[len(prefix) + 1:].split("_")
+    if len(parts) != 2 or not all(part.isdigit() for part in parts):
+        return None
+    return int(parts[0]), int(parts[1])
+
+
+def describe(ddb, name):
+    try:
+        return ddb.describe_table(TableName=name)["Table"]
+    except ClientError as exc:
+        if exc.response["Error"]["Code"] == "ResourceNotFoundException":
+            return None
+        raise
+
+
+def _throughput(desc):
+    return {
+        "ReadCapacityUnits": desc["ReadCapacityUnits"],
+        "WriteCapacityUnits": desc["WriteCapacityUnits"],
+    }
+
+
+def create_like(ddb, name, current):
+    """Create a table with the schema and capacity of the current table"""
+    kwargs = dict(
+        TableName=name,
+        KeySchema=current["KeySchema"],
+        AttributeDefinitions=current["AttributeDefinitions"],
+        ProvisionedThroughput=_throughput(current["ProvisionedThroughput"]),
+    )
+    indexes = [
+        dict(
+            IndexName=index["IndexName"],
+            KeySchema=index["KeySchema"],
+            Projection=index["Projection"],
+            ProvisionedThroughput=_throughput(index["ProvisionedThroughput"]),
+        )
+        for index in current.get("GlobalSecondaryIndexes", [])
+    ]
+    if indexes:
+        kwargs["GlobalSecondaryIndexes"] = indexes
+    ddb.create_table(**kwargs)
+
+
+def list_tables(ddb, prefix):
+    """Returns all table names starting with prefix"""
+    names = []
+    kwargs = {}
+    while True:
+        resp = ddb.list_tables(**kwargs)
+        names.extend(name for name in resp["TableNames"]
+                     if name.startswith(prefix))
+        if "LastEvaluatedTableName" not in resp:
+            return names
+        kwargs["ExclusiveStartTableName"] = resp["LastEvaluatedTableName"]
+
+
+def rotate(ddb, prefix, today, days_ahead=DEFAULT_DAYS_AHEAD,
+           retention_months=MIN_RETENTION_MONTHS):
+    """Pre-create next month's table and retire expired ones
+
+    Returns the names of the created and deleted tables.
+
+    """
+    created, deleted = [], []
+    year, month = today.year, today.month
+    next_year, next_month = add_months(year, month, 1)
+    rollover = datetime.date(next_year, next_month, 1)
+    next_name = table_name(prefix, next_year, next_month)
+    if (rollover - today).days <= days_ahead and \
+       describe(ddb, next_name) is None:
+        current = describe(ddb, table_name(prefix, year, month))
+        if current is None:
+            print("No current table to copy capacity from, skipping create")
+        else:
+            create_like(ddb, next_name, current)
+            created.append(next_name)
+
+    retention_months = max(retention_months, MIN_RETENTION_MONTHS)
+    oldest = add_months(year, month, 1 - retention_months)
+    for name in list_tables(ddb, prefix):
+        table_month = parse_table_month(prefix, name)
+        if table_month is not None and table_month < oldest:
+            ddb.delete_table(TableName=name)
+            deleted.append(name)
+    return created, deleted
+
+
+def lambda_handler(event, context):
+    ddb = boto3.client("dynamodb")
+    created, deleted = rotate(
+        ddb,
+        event["table_prefix"],
+        datetime.datetime.utcnow().date(),
+        days_ahead=int(event.get("days_ahead", DEFAULT_DAYS_AHEAD)),
+        retention_months=int(event.get("retention_months",
+                                       MIN_RETENTION_MONTHS)),
+    )
+    print("Created: {}, deleted: {}".format(created, deleted))
+    return {"created": created, "deleted": deleted}
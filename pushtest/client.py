@@ -0,0 +1,249 @@
+"""Push load generator workload
+
+Run as a script it drives a number of concurrent connections that each
+send notifications to themselves through the endpoint at a fixed rate,
+and reports delivery latency. Sends follow a fixed clock whether or not
+earlier notifications have arrived, and latency is measured from when a
+send was due, so a slow server shows up as latency and missed sends
+instead of a lower rate. Results can be written to S3.
+
+Run against a local stand-in server:
+
+    $ python -m pushtest.client --standin --connections 20 --rate 100
+
+"""
+import collections
+import json
+import socket
+import threading
+import time
+import urllib2
+import uuid
+
+import click
+import websocket
+
+from pushtest.protocol import PushClient, PushError
+
+
+METADATA_URL = "http://169.254.169.254/latest/meta-data/instance-id"
+CONNECTION_ERRORS = (PushError, websocket.WebSocketException, socket.error,
+                     urllib2.URLError, ValueError)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(int(round(pct / 100.0 * (len(ordered) - 1))),
+                len(ordered) - 1)
+    return ordered[index]
+
+
+class Stats(object):
+    """Thread-safe counters of a load test run"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connected = 0
+        self.sent = 0
+        # Sends skipped as the previous one ran into their slot
+        self.missed = 0
+        self.received = 0
+        # Sends not delivered within the timeout
+        self.lost = 0
+        self.errors = {}
+        self.latencies = []
+
+    def add(self, field, count=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + count)
+
+    def error(self, exc):
+        name = type(exc).__name__
+        with self._lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def latency(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.received += 1
+
+    def summary(self, duration):
+        with self._lock:
+            latencies = list(self.latencies)
+            return {
+                "duration": round(duration, 3),
+                "connected": self.connected,
+                "sent": self.sent,
+                "missed": self.missed,
+                "received": self.received,
+                "lost": self.lost,
+                "errors": dict(self.errors),
+                "throughput": round(self.received / duration, 2)
+                if duration else 0.0,
+                "latency_ms": {
+                    "p50": round(percentile(latencies, 50) * 1000, 2),
+                    "p90": round(percentile(latencies, 90) * 1000, 2),
+                    "p99": round(percentile(latencies, 99) * 1000, 2),
+                    "max": round(max(latencies or [0]) * 1000, 2),
+                },
+            }
+
+
+def _receive(client, channel_id, outstanding, sending, stats, timeout):
+    """Match notifications to the outstanding sends, oldest first"""
+    try:
+        while sending.is_set() or outstanding:
+            try:
+                client.receive(channel_id)
+            except websocket.WebSocketTimeoutException:
+                pass
+            else:
+                received = time.time()
+                if outstanding:
+                    stats.latency(received - outstanding.popleft())
+            expired = time.time() - timeout
+            while outstanding and outstanding[0] < expired:
+                outstanding.popleft()
+                stats.add("lost")
+    except CONNECTION_ERRORS as exc:
+        if sending.is_set():
+            stats.error(exc)
+        sending.clear()
+
+
+def run_connection(url, interval, deadline, stats, timeout=30):
+    """Notify one connection every interval seconds until the deadline
+
+    Notifications are received on a separate thread, so a send is never
+    held up waiting for the previous one to arrive. A send that can't
+    start before the next one is due is skipped and counted as missed.
+
+    """
+    client = PushClient(url, timeout)
+    try:
+        client.connect()
+        channel_id, endpoint = client.register()
+    except CONNECTION_ERRORS as exc:
+        stats.error(exc)
+        client.close()
+        return
+    stats.add("connected")
+    # Due times of the sends not received yet
+    outstanding = collections.deque()
+    sending = threading.Event()
+    sending.set()
+    receiver = threading.Thread(
+        target=_receive,
+        args=(client, channel_id, outstanding, sending, stats, timeout),
+    )
+    receiver.daemon = True
+    receiver.start()
+    due = time.time()
+    try:
+        while due < deadline and sending.is_set():
+            now = time.time()
+            if now >= due + interval:
+                stats.add("missed")
+                due += interval
+                continue
+            time.sleep(max(due - now, 0))
+            outstanding.append(due)
+            try:
+                client.notify(endpoint)
+            except CONNECTION_ERRORS:
+                try:
+                    outstanding.remove(due)
+                except ValueError:
+                    pass
+                raise
+            stats.add("sent")
+            due += interval
+    except CONNECTION_ERRORS as exc:
+        stats.error(exc)
+    finally:
+        sending.clear()
+        # Wait out the notifications still in flight, then closing the
+        # connection stops the receiver
+        give_up = time.time() + timeout
+        while outstanding and receiver.is_alive() and time.time() < give_up:
+            time.sleep(0.05)
+        client.close()
+        receiver.join(timeout)
+        stats.add("lost", len(outstanding))
+
+
+def run_workload(url, connections, rate, duration, ramp=5.0, timeout=30):
+    """Run the load test, returns its summary
+
+    rate is the total notifications per second across all connections,
+    which are opened evenly over the first ramp seconds.
+
+    """
+    stats = Stats()
+    interval = float(connections) / rate
+    started = time.time()
+    deadline = started + ramp + duration
+    threads = []
+    for index in range(connections):
+        thread = threading.Thread(
+            target=run_connection,
+            args=(url, interval, deadline, stats, timeout),
+        )
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+        time.sleep(float(ramp) / connections)
+    for thread in threads:
+        thread.join(timeout * 2 + deadline - time.time())
+    summary = stats.summary(time.time() - started)
+    summary.update(url=url, connections=connections, rate=rate)
+    return summary
+
+
+def instance_id():
+    """The EC2 instance id, or a random id outside of EC2"""
+    try:
+        return urllib2.urlopen(METADATA_URL, timeout=2).read()
+    except (urllib2.URLError, socket.error):
+        return "local-" + uuid.uuid4().hex[:8]
+
+
+@click.command()
+@click.option("--url", help="Push websocket URL")
+@click.option("--standin", is_flag=True,
+              help="Run against a local stand-in Push server")
+@click.option("--connections", default=10, help="Connections to open")
+@click.option("--rate", default=10.0, help="Total notifications per second")
+@click.option("--duration", default=30.0,
+              help="Seconds to send for after the ramp up")
+@click.option("--ramp", default=5.0,
+              help="Seconds to open all connections over")
+@click.option("--results-bucket", help="S3 bucket to write the results to")
+@click.option("--results-prefix", default="",
+              help="Key prefix of the results in the bucket")
+def main(url, standin, connections, rate, duration, ramp, results_bucket,
+         results_prefix):
+    if not url and not standin:
+        raise click.UsageError("--url or --standin is required")
+
+    if standin:
+        from pushtest.standin import PushServer
+        with PushServer() as server:
+            summary = run_workload(server.url, connections, rate, duration,
+                                   ramp)
+    else:
+        summary = run_workload(url, connections, rate, duration, ramp)
+    body = json.dumps(summary, indent=2, sort_keys=True)
+    click.echo(body)
+    if results_bucket:
+        import boto3
+        key = "%s%s.json" % (results_prefix, instance_id())
+        boto3.client("s3").put_object(
+            Bucket=results_bucket, Key=key, Body=body,
+            ContentType="application/json")
+        click.echo("Results written to s3://%s/%s" % (results_bucket, key))
+
+
+if __name__ == '__main__':
+    main()
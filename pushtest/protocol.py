@@ -0,0 +1,101 @@
+"""Push websocket protocol client
+
+``PushClient`` speaks the autopush websocket protocol: hello, register and
+unregister channels, receive and ack notifications, and sends notifications
+through the push endpoint returned at registration. The websocket is
+``websocket-client``'s, which the canary zip and load generators install
+alongside this package.
+
+"""
+import json
+import urllib2
+import uuid
+
+import websocket
+
+
+class PushError(Exception):
+    pass
+
+
+class PushClient(object):
+    """A single Push websocket connection"""
+    def __init__(self, url, timeout=30, uaid=None):
+        self.url = url
+        self.timeout = timeout
+        # Set to resume an earlier connection's registrations
+        self.uaid = uaid
+        self.ws = None
+        self.endpoints = {}
+
+    def _send(self, **message):
+        self.ws.send(json.dumps(message))
+
+    def _expect(self, message_type):
+        """Returns the next message of message_type
+
+        Notifications that arrive in the meantime are acked and skipped.
+
+        """
+        while True:
+            message = json.loads(self.ws.recv())
+            if message.get("messageType") == message_type:
+                return message
+            if message.get("messageType") == "notification":
+                self.ack(message)
+
+    def connect(self):
+        self.ws = websocket.create_connection(self.url, timeout=self.timeout)
+        self._send(messageType="hello", uaid=self.uaid or "",
+                   channelIDs=[], use_webpush=True)
+        reply = self._expect("hello")
+        if reply.get("status") != 200:
+            raise PushError("Hello failed: {}".format(reply))
+        self.uaid = reply["uaid"]
+
+    def register(self, channel_id=None):
+        """Register a channel, returns its push endpoint"""
+        channel_id = channel_id or str(uuid.uuid4())
+        self._send(messageType="register", channelID=channel_id)
+        reply = self._expect("register")
+        if reply.get("status") != 200:
+            raise PushError("Register failed: {}".format(reply))
+        self.endpoints[channel_id] = reply["pushEndpoint"]
+        return channel_id, reply["pushEndpoint"]
+
+    def unregister(self, channel_id):
+        """Unregister a channel, dropping its push endpoint"""
+        self._send(messageType="unregister", channelID=channel_id)
+        reply = self._expect("unregister")
+        if reply.get("status") != 200:
+            raise PushError("Unregister failed: {}".format(reply))
+        self.endpoints.pop(channel_id, None)
+
+    def notify(self, endpoint, ttl=60):
+        """Send an empty notification through a push endpoint"""
+        request = urllib2.Request(endpoint, data="")
+        request.add_header("TTL", str(ttl))
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError as exc:
+            raise PushError("Endpoint returned {}".format(exc.code))
+        return response.getcode()
+
+    def receive(self, channel_id):
+        """Wait for, ack and return the next notification for a channel"""
+        while True:
+            message = self._expect("notification")
+            self.ack(message)
+            if message.get("channelID") == channel_id:
+                return message
+
+    def ack(self, message):
+        self._send(messageType="ack", updates=[{
+            "channelID": message["channelID"],
+            "version": message["version"],
+        }])
+
+    def close(self):
+        if self.ws is not None:
+            self.ws.close()
+            self.ws = None
@@ -0,0 +1,208 @@
+"""Local stand-in for an autopush connection and endpoint node
+
+Speaks enough of the Push websocket protocol (hello, register, unregister,
+ack) and accepts notifications on ``/push/<channelID>`` over HTTP,
+delivering them to the connection that registered the channel. Both are
+served from one port, told apart by the websocket upgrade header.
+
+"""
+import BaseHTTPServer
+import SocketServer
+import base64
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+import websocket
+from websocket import ABNF
+
+
+# Appended to the client's key for Sec-WebSocket-Accept, per RFC 6455
+ACCEPT_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1(key + ACCEPT_GUID).digest())
+
+
+class ServerWebSocket(object):
+    """Server side of an accepted websocket
+
+    Frames are read and written with websocket-client's ABNF, unmasked as
+    a server sends them. Sending is safe from several threads.
+
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self._frames = websocket.frame_buffer(self._recv, True)
+        self._send_lock = threading.Lock()
+
+    def _recv(self, size):
+        data = self.sock.recv(size)
+        if not data:
+            raise websocket.WebSocketConnectionClosedException(
+                "Connection closed")
+        return data
+
+    def _send_frame(self, opcode, data):
+        frame = ABNF(1, 0, 0, 0, opcode, 0, data)
+        with self._send_lock:
+            self.sock.sendall(frame.format())
+
+    def send(self, text):
+        self._send_frame(ABNF.OPCODE_TEXT, text)
+
+    def recv(self):
+        """Returns the next text message
+
+        Pings are answered, and a close frame is echoed back and raises
+        WebSocketConnectionClosedException.
+
+        """
+        while True:
+            frame = self._frames.recv_frame()
+            if frame.opcode == ABNF.OPCODE_TEXT:
+                return frame.data
+            if frame.opcode == ABNF.OPCODE_PING:
+                self._send_frame(ABNF.OPCODE_PONG, frame.data)
+            elif frame.opcode == ABNF.OPCODE_CLOSE:
+                self._send_frame(ABNF.OPCODE_CLOSE, frame.data[:2])
+                raise websocket.WebSocketConnectionClosedException(
+                    "Closed by peer")
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.headers.get("upgrade", "").lower() != "websocket":
+            self._reply(404)
+            return
+        key = self.headers["sec-websocket-key"]
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept_key(key))
+        self.end_headers()
+        self.wfile.flush()
+        self.server.serve_connection(ServerWebSocket(self.connection))
+        self.close_connection = 1
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length") or 0)
+        data = self.rfile.read(length) if length else ""
+        if not self.path.startswith("/push/"):
+            self._reply(404)
+            return
+        channel_id = self.path[len("/push/"):]
+        self._reply(201 if self.server.deliver(channel_id, data) else 404)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class PushServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded stand-in Push server on a local port
+
+    Use as a context manager; ``url`` is the websocket URL to connect to.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, delay=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), _Handler)
+        # Simulated delivery delay in seconds
+        self.delay = delay
+        self._lock = threading.Lock()
+        # channel id -> websocket
+        self.channels = {}
+        self.delivered = 0
+        self.unregistered = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        return "ws://127.0.0.1:%d/" % self.server_port
+
+    @property
+    def endpoint_url(self):
+        return "http://127.0.0.1:%d/push/" % self.server_port
+
+    def serve_connection(self, ws):
+        channels = []
+        try:
+            while True:
+                message = json.loads(ws.recv())
+                message_type = message.get("messageType")
+                if message_type == "hello":
+                    ws.send(json.dumps({
+                        "messageType": "hello", "status": 200,
+                        "uaid": message.get("uaid") or uuid.uuid4().hex,
+                        "use_webpush": True,
+                    }))
+                elif message_type == "register":
+                    channel_id = message["channelID"]
+                    with self._lock:
+                        self.channels[channel_id] = ws
+                    channels.append(channel_id)
+                    ws.send(json.dumps({
+                        "messageType": "register", "status": 200,
+                        "channelID": channel_id,
+                        "pushEndpoint": self.endpoint_url + channel_id,
+                    }))
+                elif message_type == "unregister":
+                    channel_id = message["channelID"]
+                    with self._lock:
+                        self.channels.pop(channel_id, None)
+                        self.unregistered += 1
+                    if channel_id in channels:
+                        channels.remove(channel_id)
+                    ws.send(json.dumps({
+                        "messageType": "unregister", "status": 200,
+                        "channelID": channel_id,
+                    }))
+                elif message_type == "ping":
+                    ws.send("{}")
+        except (websocket.WebSocketException, IOError, ValueError,
+                KeyError):
+            pass
+        finally:
+            with self._lock:
+                for channel_id in channels:
+                    self.channels.pop(channel_id, None)
+
+    def deliver(self, channel_id, data):
+        """Send a notification to a channel, False if it's not connected"""
+        with self._lock:
+            ws = self.channels.get(channel_id)
+        if ws is None:
+            return False
+        if self.delay:
+            time.sleep(self.delay)
+        try:
+            ws.send(json.dumps({
+                "messageType": "notification", "channelID": channel_id,
+                "version": uuid.uuid4().hex, "data": data,
+            }))
+        except (websocket.WebSocketException, IOError):
+            return False
+        with self._lock:
+            self.delivered += 1
+        return True
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,57 @@
+"""CloudFormation resource types missing from the pinned troposphere"""
+from troposphere import AWSObject, AWSProperty
+from troposphere.awslambda import Function
+from troposphere.cloudwatch import Alarm
+from troposphere.validators import positive_integer
+
+
+class DAXCluster(AWSObject):
+    resource_type = "AWS::DAX::Cluster"
+
+    props = {
+        'ClusterName': (basestring, False),
+        'Description': (basestring, False),
+        'IAMRoleARN': (basestring, True),
+        'NodeType': (basestring, True),
+        'ReplicationFactor': (positive_integer, True),
+        'SecurityGroupIds': ([basestring], False),
+        'SubnetGroupName': (basestring, False),
+        'Tags': (dict, False),
+    }
+
+
+class DAXSubnetGroup(AWSObject):
+    resource_type = "AWS::DAX::SubnetGroup"
+
+    props = {
+        'Description': (basestring, False),
+        'SubnetGroupName': (basestring, False),
+        'SubnetIds': ([basestring], True),
+    }
+
+
+class LambdaEnvironment(AWSProperty):
+    props = {
+        'Variables': (dict, True),
+    }
+
+
+class EnvironmentFunction(Function):
+    """Lambda Function that also accepts environment variables"""
+    props = dict(Function.props, Environment=(LambdaEnvironment, False))
+
+
+class MissingDataAlarm(Alarm):
+    """CloudWatch Alarm that also accepts TreatMissingData"""
+    props = dict(Alarm.props, TreatMissingData=(basestring, False))
+
+
+class DeliveryStream(AWSObject):
+    resource_type = "AWS::KinesisFirehose::DeliveryStream"
+
+    props = {
+        'DeliveryStreamName': (basestring, False),
+        'DeliveryStreamType': (basestring, False),
+        'ExtendedS3DestinationConfiguration': (dict, False),
+        'S3DestinationConfiguration': (dict, False),
+    }
@@ -0,0 +1,341 @@
+"""CloudFormation stack operations for deploying generated templates
+
+Creates, updates or deletes stacks through the CloudFormation API,
+streams their events while waiting, and collects per-resource timings
+from the event timestamps.
+
+"""
+from __future__ import print_function
+
+import json
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+from customresources.enicleanup.lambda_function import release_all
+
+
+SUCCESS_STATES = ["CREATE_COMPLETE", "UPDATE_COMPLETE", "DELETE_COMPLETE"]
+STACK_RESOURCE_TYPE = "AWS::CloudFormation::Stack"
+SECURITY_GROUP_TYPE = "AWS::EC2::SecurityGroup"
+NO_UPDATES = "No updates are to be performed"
+# Largest TemplateBody the CloudFormation API accepts, in bytes
+MAX_TEMPLATE_BODY = 51200
+
+# Adaptive polling for stack events, in seconds
+MIN_POLL_INTERVAL = 2.0
+MAX_POLL_INTERVAL = 30.0
+POLL_BACKOFF = 1.5
+
+
+def is_terminal(status):
+    return not status.endswith("_IN_PROGRESS")
+
+
+def parse_parameters(pairs):
+    """Turns a list of KEY=VALUE strings into a parameter dict"""
+    params = {}
+    for pair in pairs:
+        if "=" not in pair:
+            raise ValueError("Parameter must be KEY=VALUE: %s" % pair)
+        key, value = pair.split("=", 1)
+        params[key] = value
+    return params
+
+
+class StackResult(object):
+    """Outcome of a single stack operation"""
+    def __init__(self, stack_name):
+        self.stack_name = stack_name
+        self.action = None
+        self.status = None
+        self.elapsed = 0.0
+        self.error = None
+        # LogicalResourceId -> [start, end, final status]
+        self.resources = {}
+
+    @property
+    def ok(self):
+        return self.error is None and self.status in SUCCESS_STATES + [None]
+
+    def record(self, event):
+        """Track the start and end timestamp of a resource from an event"""
+        timing = self.resources.setdefault(
+            event["LogicalResourceId"], [None, None, None])
+        if event["ResourceStatus"].endswith("_IN_PROGRESS"):
+            if timing[0] is None:
+                timing[0] = event["Timestamp"]
+        else:
+            timing[1] = event["Timestamp"]
+            timing[2] = event["ResourceStatus"]
+
+    def timings(self):
+        """Returns (logical id, seconds, status) sorted slowest first"""
+        rows = []
+        for logical_id, (start, end, status) in self.resources.items():
+            if start is None or end is None:
+                continue
+            rows.append((logical_id, (end - start).total_seconds(), status))
+        return sorted(rows, key=lambda row: row[1], reverse=True)
+
+
+class StackDeployer(object):
+    """Creates or updates CloudFormation stacks from a template body
+
+    Stacks are run concurrently with at most ``concurrency`` in flight.
+    An existing stack is updated, re-using the previous value of any
+    parameter that isn't explicitly supplied so that generated defaults
+    (such as the crypto key and table prefix) stay stable.
+
+    """
+    def __init__(self, template_body, parameters=None, concurrency=4,
+                 region=None, endpoint_url=None, client=None,
+                 echo=print):
+        self.template_body = template_body
+        self.parameters = parameters or {}
+        self.concurrency = concurrency
+        self._client = client or boto3.client(
+            "cloudformation", region_name=region, endpoint_url=endpoint_url)
+        self._echo = echo
+        self._echo_lock = threading.Lock()
+        self._template_keys = None
+
+    def _log(self, stack_name, message):
+        with self._echo_lock:
+            self._echo("[%s] %s" % (stack_name, message))
+
+    def _describe(self, stack_name):
+        try:
+            stacks = self._client.describe_stacks(
+                StackName=stack_name)["Stacks"]
+        except ClientError as exc:
+            if "does not exist" in str(exc):
+                return None
+            raise
+        return stacks[0] if stacks else None
+
+    def _template_parameters(self):
+        """Validates the template, returns its parameter names"""
+        if len(self.template_body) > MAX_TEMPLATE_BODY:
+            raise ValueError("Template is %d bytes, over the %d byte limit "
+                             "of the CloudFormation API" % (
+                                 len(self.template_body), MAX_TEMPLATE_BODY))
+        self._client.validate_template(TemplateBody=self.template_body)
+        return list(json.loads(self.template_body).get("Parameters", {}))
+
+    def _stack_parameters(self, existing):
+        previous = set()
+        if existing:
+            previous = set(p["ParameterKey"]
+                           for p in existing.get("Parameters", []))
+        params = []
+        for key in self._template_keys:
+            if key in self.parameters:
+                params.append(dict(ParameterKey=key,
+                                   ParameterValue=self.parameters[key]))
+            elif key in previous:
+                params.append(dict(ParameterKey=key, UsePreviousValue=True))
+        return params
+
+    def _latest_event_id(self, stack_id):
+        events = self._client.describe_stack_events(
+            StackName=stack_id)["StackEvents"]
+        return events[0]["EventId"] if events else None
+
+    def _new_events(self, stack_id, last_seen):
+        """Returns events newer than last_seen, oldest first"""
+        events = []
+        paginator = self._client.get_paginator("describe_stack_events")
+        for page in paginator.paginate(StackName=stack_id):
+            for event in page["StackEvents"]:
+                if event["EventId"] == last_seen:
+                    return list(reversed(events))
+                events.append(event)
+        return list(reversed(events))
+
+    def _stream(self, stack_id, last_seen, result):
+        """Streams stack events until the stack reaches a terminal state
+
+        The poll interval backs off while nothing happens and resets as
+        soon as new events show up.
+
+        """
+        interval = MIN_POLL_INTERVAL
+        while True:
+            events = self._new_events(stack_id, last_seen)
+            for event in events:
+                last_seen = event["EventId"]
+                result.record(event)
+                self._log(result.stack_name, "%s %s %s %s" % (
+                    event["ResourceStatus"],
+                    event["ResourceType"],
+                    event["LogicalResourceId"],
+                    event.get("ResourceStatusReason", ""),
+                ))
+                if event["ResourceType"] == STACK_RESOURCE_TYPE and \
+                   event["PhysicalResourceId"] == stack_id and \
+                   is_terminal(event["ResourceStatus"]):
+                    return event["ResourceStatus"]
+            if events:
+                interval = MIN_POLL_INTERVAL
+            else:
+                interval = min(interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+            time.sleep(interval)
+
+    def apply_stack(self, stack_name):
+        result = StackResult(stack_name)
+        started = time.time()
+        try:
+            if self._template_keys is None:
+                self._template_keys = self._template_parameters()
+            existing = self._describe(stack_name)
+            if existing and existing["StackStatus"] == "ROLLBACK_COMPLETE":
+                raise ValueError("Stack is in ROLLBACK_COMPLETE and must be "
+                                 "deleted before it can be re-created")
+            kwargs = dict(
+                StackName=stack_name,
+                TemplateBody=self.template_body,
+                Parameters=self._stack_parameters(existing),
+                Capabilities=["CAPABILITY_IAM"],
+            )
+            if existing:
+                result.action = "update"
+                last_seen = self._latest_event_id(existing["StackId"])
+                try:
+                    stack_id = self._client.update_stack(**kwargs)["StackId"]
+                except ClientError as exc:
+                    if NO_UPDATES not in str(exc):
+                        raise
+                    self._log(stack_name, "No updates to perform")
+                    return result
+            else:
+                result.action = "create"
+                last_seen = None
+                stack_id = self._client.create_stack(**kwargs)["StackId"]
+            self._log(stack_name, "%s started" % result.action)
+            result.status = self._stream(stack_id, last_seen, result)
+        except Exception as exc:
+            result.error = str(exc)
+            self._log(stack_name, "Failed: %s" % exc)
+        finally:
+            result.elapsed = time.time() - started
+        return result
+
+    def apply(self, stack_names):
+        """Applies the template to all stacks, returns their results
+
+        A template that fails validation fails every stack without
+        touching any of them.
+
+        """
+        if self._template_keys is None:
+            try:
+                self._template_keys = self._template_parameters()
+            except (ClientError, ValueError) as exc:
+                results = []
+                for stack_name in stack_names:
+                    result = StackResult(stack_name)
+                    result.error = str(exc)
+                    self._log(stack_name, "Invalid template: %s" % exc)
+                    results.append(result)
+                return results
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(self.apply_stack, stack_names))
+
+
+class StackTeardown(StackDeployer):
+    """Deletes CloudFormation stacks, clearing Lambda network interfaces
+
+    While a stack deletes, the Lambda network interfaces in its VPC
+    security groups are detached and deleted as they're released, so
+    stacks created before the ENI cleanup resource existed don't stall
+    on their security groups either.
+
+    """
+    def __init__(self, concurrency=4, region=None, endpoint_url=None,
+                 client=None, ec2_client=None, echo=print):
+        StackDeployer.__init__(self, None, concurrency=concurrency,
+                               region=region, endpoint_url=endpoint_url,
+                               client=client, echo=echo)
+        self._ec2 = ec2_client or boto3.client(
+            "ec2", region_name=region, endpoint_url=endpoint_url)
+
+    def _security_groups(self, stack_id):
+        """VPC security group ids of a stack, by their sg- physical id"""
+        resources = self._client.describe_stack_resources(
+            StackName=stack_id)["StackResources"]
+        return [res["PhysicalResourceId"] for res in resources
+                if res["ResourceType"] == SECURITY_GROUP_TYPE and
+                res.get("PhysicalResourceId", "").startswith("sg-")]
+
+    def _sweep(self, stack_name, group_ids, stop):
+        """Release network interfaces with backoff until stopped"""
+        interval = MIN_POLL_INTERVAL
+        while True:
+            try:
+                remaining = release_all(self._ec2, group_ids,
+                                        self.concurrency)
+            except ClientError as exc:
+                self._log(stack_name, "ENI cleanup failed: %s" % exc)
+                remaining = 0
+            if remaining:
+                self._log(stack_name, "%d network interfaces left" %
+                          remaining)
+                interval = MIN_POLL_INTERVAL
+            else:
+                interval = min(interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+            if stop.wait(interval):
+                return
+
+    def teardown_stack(self, stack_name):
+        result = StackResult(stack_name)
+        result.action = "delete"
+        started = time.time()
+        stop = threading.Event()
+        sweeper = None
+        try:
+            existing = self._describe(stack_name)
+            if existing is None:
+                self._log(stack_name, "Stack does not exist")
+                return result
+            stack_id = existing["StackId"]
+            group_ids = self._security_groups(stack_id)
+            last_seen = self._latest_event_id(stack_id)
+            self._client.delete_stack(StackName=stack_id)
+            self._log(stack_name, "delete started")
+            if group_ids:
+                sweeper = threading.Thread(
+                    target=self._sweep, args=(stack_name, group_ids, stop))
+                sweeper.daemon = True
+                sweeper.start()
+            result.status = self._stream(stack_id, last_seen, result)
+        except Exception as exc:
+            result.error = str(exc)
+            self._log(stack_name, "Failed: %s" % exc)
+        finally:
+            stop.set()
+            if sweeper is not None:
+                sweeper.join()
+            result.elapsed = time.time() - started
+        return result
+
+    def teardown(self, stack_names):
+        """Deletes all stacks, returns their results"""
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(self.teardown_stack, stack_names))
+
+
+def format_timings(result):
+    """Returns a printable per-resource timing summary for a stack"""
+    lines = ["%s: %s %s in %.1fs" % (
+        result.stack_name,
+        result.action or "apply",
+        result.error or result.status or "unchanged",
+        result.elapsed,
+    )]
+    for logical_id, seconds, status in result.timings():
+        lines.append("  %8.1fs  %-24s %s" % (seconds, status, logical_id))
+    return "\n".join(lines)
@@ -0,0 +1,38 @@
+import boto3
+import pytest
+from moto import mock_ec2
+
+from customresources.enicleanup import lambda_function
+
+
+@pytest.fixture
+def ec2():
+    with mock_ec2():
+        yield boto3.client("ec2", region_name="us-east-1")
+
+
+def create_group(ec2, vpc_id, name):
+    return ec2.create_security_group(
+        GroupName=name, Description=name, VpcId=vpc_id)["GroupId"]
+
+
+def test_release_all_only_releases_lambda_interfaces(ec2):
+    vpc_id = ec2.create_vpc(CidrBlock="10.0.0.0/16")["Vpc"]["VpcId"]
+    subnet_id = ec2.create_subnet(
+        VpcId=vpc_id, CidrBlock="10.0.0.0/24")["Subnet"]["SubnetId"]
+    group_id = create_group(ec2, vpc_id, "lambda")
+    other_id = create_group(ec2, vpc_id, "other")
+    for groups, description in [
+            ([group_id], "AWS Lambda VPC ENI: 1"),
+            ([group_id], "AWS Lambda VPC ENI: 2"),
+            ([group_id], "autopush"),
+            ([other_id], "AWS Lambda VPC ENI: 3")]:
+        ec2.create_network_interface(SubnetId=subnet_id, Groups=groups,
+                                     Description=description)
+
+    assert len(lambda_function.lambda_interfaces(ec2, [group_id])) == 2
+    assert lambda_function.release_all(ec2, [group_id]) == 0
+    assert lambda_function.lambda_interfaces(ec2, [group_id]) == []
+    left = ec2.describe_network_interfaces()["NetworkInterfaces"]
+    assert sorted(eni["Description"] for eni in left) == [
+        "AWS Lambda VPC ENI: 3", "autopush"]
@@ -0,0 +1,65 @@
+import datetime
+
+from botocore.exceptions import ClientError
+
+from lambdas.messagetables.lambda_function import (
+    parse_table_month,
+    rotate,
+    table_name,
+)
+
+
+PREFIX = "push_message"
+
+SCHEMA = {
+    "KeySchema": [{"AttributeName": "uaid", "KeyType": "HASH"}],
+    "AttributeDefinitions": [{"AttributeName": "uaid",
+                              "AttributeType": "S"}],
+    "ProvisionedThroughput": {"ReadCapacityUnits": 50,
+                              "WriteCapacityUnits": 25},
+}
+
+
+class FakeDynamoDB(object):
+    def __init__(self, names):
+        self.tables = dict((name, dict(SCHEMA, TableName=name))
+                           for name in names)
+
+    def describe_table(self, TableName):
+        if TableName not in self.tables:
+            raise ClientError(
+                {"Error": {"Code": "ResourceNotFoundException"}},
+                "DescribeTable")
+        return {"Table": self.tables[TableName]}
+
+    def create_table(self, **kwargs):
+        self.tables[kwargs["TableName"]] = kwargs
+
+    def delete_table(self, TableName):
+        del self.tables[TableName]
+
+    def list_tables(self, **kwargs):
+        return {"TableNames": sorted(self.tables)}
+
+
+def test_single_digit_months_are_not_zero_padded():
+    assert table_name(PREFIX, 2017, 1) == "push_message_2017_1"
+    assert table_name(PREFIX, 2016, 12) == "push_message_2016_12"
+    assert parse_table_month(PREFIX, "push_message_2017_1") == (2017, 1)
+
+
+def test_rotate_into_a_single_digit_month():
+    ddb = FakeDynamoDB(["push_message_2016_10", "push_message_2016_11",
+                        "push_message_2016_12"])
+    created, deleted = rotate(ddb, PREFIX, datetime.date(2016, 12, 28),
+                              retention_months=2)
+    assert created == ["push_message_2017_1"]
+    assert deleted == ["push_message_2016_10"]
+    assert ddb.tables["push_message_2017_1"]["ProvisionedThroughput"] == \
+        SCHEMA["ProvisionedThroughput"]
+
+
+def test_rotate_finds_the_current_single_digit_month():
+    ddb = FakeDynamoDB(["push_message_2017_1"])
+    created, _ = rotate(ddb, PREFIX, datetime.date(2017, 1, 30))
+    assert created == ["push_message_2017_2"]
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+
+import boto3
+import pytest
+from moto import mock_s3
+
+from customresources import cfnresponse
+from customresources.s3writer import lambda_function
+
+
+BUCKET = "push-settings"
+
+
+class FakeContext(object):
+    log_stream_name = "2017/01/01/[$LATEST]0123456789abcdef"
+    invoked_function_arn = "arn:aws:lambda:us-east-1:123456789012:" \
+        "function:S3Writer"
+
+    def get_remaining_time_in_millis(self):
+        return 300 * 1000
+
+
+class Response(object):
+    def getcode(self):
+        return 200
+
+    msg = "OK"
+
+
+@pytest.fixture
+def responses(monkeypatch):
+    """Captures the response bodies PUT to the ResponseURL"""
+    bodies = []
+
+    class Opener(object):
+        def open(self, request, timeout=None):
+            bodies.append(request.get_data())
+            return Response()
+
+    monkeypatch.setattr(cfnresponse.urllib2, "build_opener",
+                        lambda *handlers: Opener())
+    return bodies
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    with mock_s3():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=BUCKET)
+        monkeypatch.setitem(lambda_function._clients, "s3", s3)
+        yield s3
+
+
+def create_event(files):
+    return {
+        "RequestType": "Create",
+        "ResponseURL": "https://cloudformation-custom-resource-response",
+        "StackId": "arn:aws:cloudformation:us-east-1:123456789012:"
+                   "stack/push/0123",
+        "RequestId": "request",
+        "LogicalResourceId": "ProcessorS3Settings",
+        "ResourceType": "Custom::S3Writer",
+        "ResourceProperties": {"Bucket": BUCKET, "Files": files},
+    }
+
+
+def test_large_batch_response_fits_the_limit(s3, responses):
+    files = [{"Key": "settings/%04d/%s.json" % (i, "x" * 100),
+              "Content": {"index": i}} for i in range(200)]
+    lambda_function.lambda_handler(create_event(files), FakeContext())
+    body, = responses
+    assert len(body) <= cfnresponse.MAX_RESPONSE_BODY
+    response = json.loads(body)
+    assert response["Status"] == cfnresponse.SUCCESS, response
+    assert response["Data"]["Count"] == "200"
+    assert response["Data"]["Written"] == "200"
+    listed = s3.list_objects(Bucket=BUCKET, MaxKeys=1000)["Contents"]
+    assert len(listed) == 200
+
+
+def test_oversized_response_fails_before_sending(responses):
+    event = create_event([])
+    with pytest.raises(ValueError) as exc:
+        cfnresponse.send(event, FakeContext(), cfnresponse.SUCCESS,
+                         response_data={"Data": "x" * 5000})
+    assert "4096 byte limit" in str(exc.value)
+    assert responses == []
+
+
+def test_non_ascii_keys(s3, responses):
+    files = [{"Key": u"réglages/%d.txt" % i,
+              "Content": base64.urlsafe_b64encode("push")}
+             for i in range(2)]
+    lambda_function.lambda_handler(create_event(files), FakeContext())
+    response = json.loads(responses[0])
+    assert response["Status"] == cfnresponse.SUCCESS, response
+    assert response["Data"]["Arn"].startswith(
+        "arn:aws:s3:::%s:files-" % BUCKET)
@@ -0,0 +1,116 @@
+import json
+
+import boto3
+from botocore.exceptions import ClientError
+from moto import mock_cloudformation
+
+from stackops import NO_UPDATES, StackDeployer
+
+
+REGION = "us-east-1"
+
+TEMPLATE = json.dumps({
+    "AWSTemplateFormatVersion": "2010-09-09",
+    "Parameters": {
+        "TablePrefix": {"Type": "String", "Default": "push"},
+    },
+    "Resources": {
+        "Handle": {"Type": "AWS::CloudFormation::WaitConditionHandle"},
+    },
+    "Outputs": {
+        "TablePrefix": {"Value": {"Ref": "TablePrefix"}},
+    },
+}, separators=(',', ':'))
+
+
+def quiet(message):
+    pass
+
+
+def deployer(template_body, **kwargs):
+    client = boto3.client("cloudformation", region_name=REGION)
+    return StackDeployer(template_body, client=client, echo=quiet, **kwargs)
+
+
+def stack_parameters(stack_name):
+    client = boto3.client("cloudformation", region_name=REGION)
+    stack = client.describe_stacks(StackName=stack_name)["Stacks"][0]
+    return {p["ParameterKey"]: p["ParameterValue"]
+            for p in stack.get("Parameters", [])}
+
+
+@mock_cloudformation
+def test_create():
+    results = deployer(TEMPLATE, parameters={"TablePrefix": "one"}).apply(
+        ["pushA", "pushB"])
+    assert [r.stack_name for r in results] == ["pushA", "pushB"]
+    for result in results:
+        assert result.ok, result.error
+        assert result.action == "create"
+        assert result.status == "CREATE_COMPLETE"
+        assert stack_parameters(result.stack_name) == {"TablePrefix": "one"}
+
+
+class NoUpdatesClient(object):
+    """Answers update_stack like CloudFormation does for an unchanged stack
+
+    moto applies every update, so this records the call and refuses it.
+
+    """
+    def __init__(self, client):
+        self._client = client
+        self.updates = []
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def update_stack(self, **kwargs):
+        self.updates.append(kwargs)
+        raise ClientError({"Error": {"Code": "ValidationError",
+                                     "Message": NO_UPDATES + "."}},
+                          "UpdateStack")
+
+
+@mock_cloudformation
+def test_unchanged_update_keeps_previous_parameters():
+    deployer(TEMPLATE, parameters={"TablePrefix": "one"}).apply(["pushA"])
+    client = NoUpdatesClient(
+        boto3.client("cloudformation", region_name=REGION))
+    result, = StackDeployer(TEMPLATE, client=client, echo=quiet).apply(
+        ["pushA"])
+    assert result.ok, result.error
+    assert result.action == "update"
+    assert result.status is None
+    update, = client.updates
+    assert update["Parameters"] == [
+        {"ParameterKey": "TablePrefix", "UsePreviousValue": True}]
+    stack = client.describe_stacks(StackName="pushA")["Stacks"][0]
+    assert stack["StackStatus"] == "CREATE_COMPLETE"
+    assert stack_parameters("pushA") == {"TablePrefix": "one"}
+
+
+@mock_cloudformation
+def test_invalid_template_fails_every_stack():
+    body = json.dumps({
+        "Resources": {
+            "Handle": {"Type": "AWS::CloudFormation::WaitConditionHandle"},
+        },
+        "Outputs": {
+            "Missing": {"Value": {"Ref": "Missing"}},
+        },
+    })
+    results = deployer(body).apply(["pushA", "pushB"])
+    assert [r.stack_name for r in results] == ["pushA", "pushB"]
+    for result in results:
+        assert not result.ok
+        assert "ValidationError" in result.error
+    client = boto3.client("cloudformation", region_name=REGION)
+    assert client.describe_stacks()["Stacks"] == []
+
+
+def test_oversized_template_fails_before_the_api():
+    body = json.dumps({"Description": "x" * 60000})
+    result, = StackDeployer(body, client=object(), echo=quiet).apply(
+        ["pushA"])
+    assert not result.ok
+    assert "byte limit" in result.error
@@ -0,0 +1,53 @@
+"""Run the delivery latency canary probe without Lambda
+
+Probes a Push server, or a local stand-in, and prints the metrics the
+canary would publish instead of sending them to CloudWatch.
+
+Run:
+
+    $ python -m tools.canary_probe --standin --count 20
+    $ python -m tools.canary_probe --url ws://push.example.com:8080/
+
+"""
+import json
+
+import click
+
+from lambdas.canary import lambda_function
+from pushtest.standin import PushServer
+
+
+def run_probe(url, count, timeout, stack):
+    result = lambda_function.probe(url, count=count, timeout=timeout)
+    return result, lambda_function.metric_data(result, stack)
+
+
+@click.command()
+@click.option("--url", help="Push websocket URL")
+@click.option("--standin", is_flag=True,
+              help="Probe a local stand-in Push server")
+@click.option("--delay", default=0.0,
+              help="Stand-in delivery delay in seconds")
+@click.option("--count", default=lambda_function.DEFAULT_COUNT,
+              help="Notifications to send")
+@click.option("--timeout", default=lambda_function.DEFAULT_TIMEOUT,
+              help="Seconds to wait for each delivery")
+@click.option("--stack", default="local", help="Stack metric dimension")
+def main(url, standin, delay, count, timeout, stack):
+    if not url and not standin:
+        raise click.UsageError("--url or --standin is required")
+    if standin:
+        with PushServer(delay=delay) as server:
+            result, metrics = run_probe(server.url, count, timeout, stack)
+    else:
+        result, metrics = run_probe(url, count, timeout, stack)
+    click.echo("Delivered %d of %d, errors: %s" % (
+        len(result["latencies"]), result["attempts"],
+        json.dumps(result["errors"])))
+    for metric in metrics:
+        click.echo("%-20s %9.2f %s" % (metric["MetricName"], metric["Value"],
+                                       metric["Unit"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+"""Replay Firehose logs through a Push log processor
+
+Feeds Firehose log objects to a processor handler the way the stack
+does: each object is put in a bucket next to ``processor_settings.json``
+and the handler gets the S3 ObjectCreated event for it. The bucket and
+ElastiCache are in-process stand-ins, so runs are repeatable and need no
+AWS account.
+
+Redis is a real redis-server given by ``--redis-url``, which should be
+one nothing else uses during the run, as its command counts are read
+from ``INFO commandstats``. Without it an in-process stand-in is used,
+whose ``--redis-latency`` simulates the round trip but not the server.
+
+Logs come from a ``FirehoseLoggingBucket`` (``--bucket``), a local copy
+in the same ``YYYY/MM/DD/HH/`` layout (``--path``), or are synthesized
+(``--synthesize``). Objects are replayed in their original order and
+spacing, divided by ``--speedup``, or back to back with ``--speedup 0``.
+
+The handler is any ``module.function`` importable from ``--handler-path``,
+such as the unpacked or zipped ``ProcessorLambdaKey``:
+
+    $ python -m tools.log_replay --path ./logs --concurrency 8 \\
+        --handler lambda.handler --handler-path push_processor_0.4.zip
+
+Without ``--handler`` a baseline handler that only counts records by type
+in Redis is used, to measure the harness itself. Handlers must create
+their clients with ``boto3.client`` and ``redis.StrictRedis``.
+
+"""
+import contextlib
+import datetime
+import gzip
+import importlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import types
+import uuid
+from StringIO import StringIO
+
+import boto3
+import click
+from concurrent.futures import ThreadPoolExecutor
+
+from tools.standins import (
+    FakeContext,
+    FakeElastiCache,
+    FakeRedis,
+    FakeS3,
+)
+
+
+BUCKET = "push-replay-logs"
+SETTINGS_KEY = "processor_settings.json"
+# Firehose names objects <stream>-<version>-YYYY-MM-DD-HH-MM-SS-<uuid>
+KEY_TIME = re.compile(r"(\d{4})-(\d\d)-(\d\d)-(\d\d)-(\d\d)-(\d\d)")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(int(round(pct / 100.0 * (len(ordered) - 1))),
+                len(ordered) - 1)
+    return ordered[index]
+
+
+def arrival_time(key):
+    """Epoch seconds Firehose wrote an object, from its name"""
+    match = KEY_TIME.search(key.rsplit("/", 1)[-1])
+    if not match:
+        return None
+    written = datetime.datetime(*[int(part) for part in match.groups()])
+    return (written - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+def count_records(body):
+    if body[:2] == "\x1f\x8b":
+        body = gzip.GzipFile(fileobj=StringIO(body)).read()
+    return sum(1 for line in body.splitlines() if line.strip())
+
+
+def load_path(path):
+    """(key, body) of the log files under a local directory"""
+    objects = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            full = os.path.join(root, name)
+            key = os.path.relpath(full, path).replace(os.sep, "/")
+            if key == SETTINGS_KEY:
+                continue
+            with open(full, "rb") as source:
+                objects.append((key, source.read()))
+    return objects
+
+
+def load_bucket(bucket, prefix, region):
+    """(key, body) of the log objects in a Firehose logging bucket"""
+    s3 = boto3.client("s3", region_name=region)
+    objects = []
+    for page in s3.get_paginator("list_objects").paginate(Bucket=bucket,
+                                                          Prefix=prefix):
+        for item in page.get("Contents", []):
+            if item["Key"] == SETTINGS_KEY or item["Key"].endswith("/"):
+                continue
+            body = s3.get_object(Bucket=bucket, Key=item["Key"])["Body"]
+            objects.append((item["Key"], body.read()))
+    return objects
+
+
+def synthesize_logs(count, records, interval=60):
+    """(key, body) of fabricated objects of autopush style log records"""
+    start = time.time() - count * interval
+    event_types = ["notification", "register", "hello", "unregister"]
+    objects = []
+    for index in range(count):
+        written = datetime.datetime.utcfromtimestamp(start + index * interval)
+        lines = []
+        for number in range(records):
+            lines.append(json.dumps({
+                "Timestamp": int((start + index * interval) * 1e9),
+                "Type": event_types[number % len(event_types)],
+                "Logger": "Autopush",
+                "Hostname": "replay",
+                "Fields": {
+                    "message_id": uuid.uuid4().hex,
+                    "message_size": 128,
+                    "jwt_aud": "https://replay.example.com",
+                },
+            }))
+        key = written.strftime("%Y/%m/%d/%H/push-logs-1-%Y-%m-%d-%H-%M-%S-") \
+            + str(uuid.uuid4())
+        objects.append((key, "\n".join(lines) + "\n"))
+    return objects
+
+
+def s3_event(bucket, key, size):
+    """S3 ObjectCreated notification for one object"""
+    return {"Records": [{
+        "eventVersion": "2.0",
+        "eventSource": "aws:s3",
+        "awsRegion": "us-east-1",
+        "eventName": "ObjectCreated:Put",
+        "s3": {
+            "s3SchemaVersion": "1.0",
+            "bucket": {"name": bucket, "arn": "arn:aws:s3:::" + bucket},
+            "object": {"key": key, "size": size},
+        },
+    }]}
+
+
+def command_calls(conn):
+    """Calls per command a redis-server has run, from INFO commandstats"""
+    return dict((name[len("cmdstat_"):], stats["calls"])
+                for name, stats in conn.info("commandstats").items())
+
+
+def load_handler(spec, path=None):
+    """Import a module.function handler, optionally from a zip or dir"""
+    if path:
+        sys.path.insert(0, os.path.abspath(path))
+    module_name, _, function = spec.rpartition(".")
+    return getattr(importlib.import_module(module_name), function)
+
+
+def baseline_handler(event, context):
+    """Counts records by type in Redis, to measure the harness itself"""
+    import redis
+    s3 = boto3.client("s3")
+    record = event["Records"][0]["s3"]
+    bucket = record["bucket"]["name"]
+    settings = json.loads(
+        s3.get_object(Bucket=bucket, Key=SETTINGS_KEY)["Body"].read())
+    cluster = boto3.client("elasticache").describe_cache_clusters(
+        CacheClusterId=settings["redis_name"], ShowCacheNodeInfo=True,
+    )["CacheClusters"][0]
+    endpoint = cluster["CacheNodes"][0]["Endpoint"]
+    conn = redis.StrictRedis(host=endpoint["Address"],
+                             port=endpoint["Port"])
+    body = s3.get_object(Bucket=bucket, Key=record["object"]["key"])
+    pipe = conn.pipeline()
+    for line in body["Body"].read().splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        pipe.hincrby("replay:types", entry.get("Type", "unknown"), 1)
+    pipe.execute()
+
+
+@contextlib.contextmanager
+def standins(s3, elasticache, redis_standin):
+    """Point boto3.client and redis.StrictRedis at the stand-ins"""
+    clients = {"s3": s3, "elasticache": elasticache}
+
+    def client(service, *args, **kwargs):
+        if service not in clients:
+            raise ValueError("No stand-in for %s" % service)
+        return clients[service]
+
+    def connect(*args, **kwargs):
+        return redis_standin
+    connect.from_url = connect
+
+    try:
+        import redis
+        added = False
+    except ImportError:
+        # The processor zip bundles redis, a local run may not have it
+        redis = types.ModuleType("redis")
+        sys.modules["redis"] = redis
+        added = True
+    saved = (boto3.client, getattr(redis, "StrictRedis", None),
+             getattr(redis, "Redis", None))
+    boto3.client = client
+    redis.StrictRedis = redis.Redis = connect
+    try:
+        yield
+    finally:
+        boto3.client, redis.StrictRedis, redis.Redis = saved
+        if added:
+            del sys.modules["redis"]
+
+
+class Replay(object):
+    """Runs a handler over log objects against the stand-ins
+
+    Import and run the handler within ``installed()``, so it picks up the
+    stand-ins even if it binds its clients at import time.
+
+    """
+    def __init__(self, settings, redis_latency=0.0, timeout=300,
+                 redis_url=None):
+        self.handler = None
+        self.timeout = timeout
+        self.s3 = FakeS3()
+        if redis_url:
+            import redis
+            self.redis = redis.StrictRedis.from_url(redis_url)
+            endpoint = self.redis.connection_pool.connection_kwargs
+            self.elasticache = FakeElastiCache(endpoint.get("host"),
+                                               endpoint.get("port"))
+            self._calls = command_calls(self.redis)
+        else:
+            self.redis = FakeRedis(latency=redis_latency)
+            self.elasticache = FakeElastiCache()
+        self.s3.put_object(Bucket=BUCKET, Key=SETTINGS_KEY,
+                           Body=json.dumps(settings))
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.lags = []
+        self.records = 0
+        self.errors = {}
+
+    def process(self, key, body, due):
+        started = time.time()
+        self.s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+        try:
+            self.handler(s3_event(BUCKET, key, len(body)),
+                         FakeContext(self.timeout))
+        except Exception as exc:
+            name = type(exc).__name__
+            with self._lock:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            return
+        with self._lock:
+            self.latencies.append(time.time() - started)
+            self.lags.append(max(started - due, 0))
+            self.records += count_records(body)
+
+    def redis_ops(self):
+        """Redis commands run since the replay was set up, by name"""
+        if isinstance(self.redis, FakeRedis):
+            return dict(self.redis.ops)
+        ops = {}
+        for name, calls in command_calls(self.redis).items():
+            calls -= self._calls.get(name, 0)
+            # Less the INFO commands reading the counts
+            if name == "info":
+                calls -= 1
+            if calls > 0:
+                ops[name] = calls
+        return ops
+
+    def installed(self):
+        return standins(self.s3, self.elasticache, self.redis)
+
+    def run(self, handler, objects, concurrency, speedup):
+        """Replay objects, returns the elapsed seconds"""
+        self.handler = handler
+        objects = sorted(objects,
+                         key=lambda obj: (arrival_time(obj[0]), obj[0]))
+        times = [arrival_time(key) for key, _ in objects]
+        first = min(t for t in times if t is not None) \
+            if any(t is not None for t in times) else None
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for (key, body), written in zip(objects, times):
+                due = started
+                if speedup and written is not None:
+                    due += (written - first) / speedup
+                    time.sleep(max(due - time.time(), 0))
+                executor.submit(self.process, key, body, due)
+        return time.time() - started
+
+
+@click.command()
+@click.option("--path", type=click.Path(exists=True, file_okay=False),
+              help="Local directory of Firehose log files")
+@click.option("--bucket", help="FirehoseLoggingBucket to copy logs from")
+@click.option("--prefix", default="", help="Key prefix within --bucket")
+@click.option("--region", default="us-east-1", help="AWS region of --bucket")
+@click.option("--synthesize", default=0,
+              help="Fabricate this many log objects instead")
+@click.option("--records", default=1000,
+              help="Records per synthesized object")
+@click.option("--handler", default=None,
+              help="Processor handler as module.function")
+@click.option("--handler-path", default=None,
+              help="Zip or directory to import the handler from")
+@click.option("--concurrency", default=4,
+              help="Concurrent handler invocations")
+@click.option("--speedup", default=0.0,
+              help="Replay speed relative to the original, 0 for no pacing")
+@click.option("--redis-name", default="push-processor",
+              help="redis_name written to processor_settings.json")
+@click.option("--file-type", default="json",
+              help="file_type written to processor_settings.json")
+@click.option("--redis-url", default=None,
+              help="redis:// URL of a redis-server to replay against")
+@click.option("--redis-latency", default=0.0,
+              help="Simulated round trip of the stand-in Redis in ms")
+def main(path, bucket, prefix, region, synthesize, records, handler,
+         handler_path, concurrency, speedup, redis_name, file_type,
+         redis_url, redis_latency):
+    if path:
+        objects = load_path(path)
+    elif bucket:
+        objects = load_bucket(bucket, prefix, region)
+    elif synthesize:
+        objects = synthesize_logs(synthesize, records)
+    else:
+        raise click.UsageError("--path, --bucket or --synthesize is required")
+    if not objects:
+        raise click.UsageError("No log objects found")
+    if redis_url and redis_latency:
+        raise click.UsageError("--redis-latency only applies without "
+                               "--redis-url")
+
+    replay = Replay(dict(redis_name=redis_name, file_type=file_type),
+                    redis_latency=redis_latency / 1000.0,
+                    redis_url=redis_url)
+    with replay.installed():
+        func = load_handler(handler, handler_path) if handler \
+            else baseline_handler
+        elapsed = replay.run(func, objects, concurrency, speedup)
+
+    ops = replay.redis_ops()
+    total_ops = sum(ops.values())
+    click.echo("%d objects, %d records in %.2fs, concurrency %d, "
+               "speedup %s" % (len(objects), replay.records, elapsed,
+                               concurrency, speedup or "none"))
+    click.echo("records/s: %.1f" % (replay.records / elapsed))
+    if redis_url:
+        click.echo("redis: %d ops (%.1f/s) on %s" % (
+            total_ops, total_ops / elapsed, redis_url))
+    else:
+        click.echo("redis: %d ops (%.1f/s) in %d round trips" % (
+            total_ops, total_ops / elapsed, replay.redis.round_trips))
+    for name, count in sorted(ops.items()):
+        click.echo("  %-10s %d" % (name, count))
+    click.echo("%-8s %9s %9s %9s %9s" % (
+        "", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for label, values in (("handler", replay.latencies),
+                          ("lag", replay.lags)):
+        click.echo("%-8s %9.1f %9.1f %9.1f %9.1f" % (
+            label,
+            percentile(values, 50) * 1000,
+            percentile(values, 90) * 1000,
+            percentile(values, 99) * 1000,
+            max(values or [0]) * 1000,
+        ))
+    if replay.errors:
+        click.echo("errors: %s" % json.dumps(replay.errors))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
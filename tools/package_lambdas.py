@@ -0,0 +1,88 @@
+"""Build, and optionally upload, the zips of the Lambdas in this repo
+
+Each zip holds the function's ``lambda_function.py`` at its root, the
+repo files it imports, and the libraries the python2.7 Lambda runtime
+lacks (``futures`` for ``concurrent.futures``, ``websocket-client`` for
+the canary), installed with pip. The
+zips are named by their S3 key in ``LambdaCodeBucket``, which carries a
+digest of their sources, so build and upload them again after any change.
+
+Run:
+
+    $ python -m tools.package_lambdas --output build
+    $ python -m tools.package_lambdas --upload-bucket my-lambda-code
+
+Then create or update the stack with ``LambdaCodeBucket=my-lambda-code``.
+
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+import boto3
+import click
+
+from deploy import LAMBDA_SOURCES, ROOT, lambda_zip_key, source_files
+
+
+def _add_staged(archive, staging):
+    """Add the pip installed files, except compiled ones"""
+    for root, _, names in os.walk(staging):
+        for name in sorted(names):
+            if name.endswith((".pyc", ".pyo")):
+                continue
+            full = os.path.join(root, name)
+            archive.write(full, os.path.relpath(full, staging))
+
+
+def build(name, output):
+    """Build the zip of a Lambda in output, returns its path"""
+    function_dir, paths, requirements = LAMBDA_SOURCES[name]
+    staging = tempfile.mkdtemp()
+    try:
+        if requirements:
+            subprocess.check_call([
+                sys.executable, "-m", "pip", "install", "--quiet",
+                "--target", staging,
+            ] + requirements)
+        zip_path = os.path.join(output, lambda_zip_key(name))
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as archive:
+            _add_staged(archive, staging)
+            archive.write(
+                os.path.join(ROOT, function_dir, "lambda_function.py"),
+                "lambda_function.py")
+            for path in paths:
+                for source in source_files(path):
+                    archive.write(os.path.join(ROOT, source), source)
+    finally:
+        shutil.rmtree(staging)
+    return zip_path
+
+
+@click.command()
+@click.option("--output", default="build", type=click.Path(file_okay=False),
+              help="Directory to write the zips to")
+@click.option("--upload-bucket", default=None,
+              help="S3 bucket to upload the zips to")
+@click.option("--region", default="us-east-1",
+              help="AWS region of --upload-bucket")
+@click.argument("names", nargs=-1, type=click.Choice(sorted(LAMBDA_SOURCES)))
+def main(output, upload_bucket, region, names):
+    """Package the named Lambdas, all of them by default"""
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    s3 = boto3.client("s3", region_name=region) if upload_bucket else None
+    for name in names or sorted(LAMBDA_SOURCES):
+        zip_path = build(name, output)
+        click.echo("Built %s" % zip_path)
+        if s3 is not None:
+            key = lambda_zip_key(name)
+            s3.upload_file(zip_path, upload_bucket, key)
+            click.echo("Uploaded s3://%s/%s" % (upload_bucket, key))
+
+
+if __name__ == '__main__':
+    main()
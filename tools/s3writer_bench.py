@@ -0,0 +1,374 @@
+"""Offline harness and latency benchmark for the S3 writer custom resource
+
+Drives ``lambda_handler`` through Create/Update/Delete cycles with
+fabricated CloudFormation events, for ``Files`` lists, single files,
+``Source`` copies and a prefix delete that needs a continuation.
+Responses go to a local HTTP server standing in for the ResponseURL,
+which rejects bodies over CloudFormation's 4096 byte limit. S3 is moto's,
+which enforces S3's 5MB minimum part size, so no AWS account is needed.
+moto comes with ``test-requirements.txt``.
+
+Every response and the resulting bucket contents are checked, exiting
+non-zero on the first mismatch. Latency percentiles per request type
+plus peak memory are reported.
+
+Run:
+
+    $ python -m tools.s3writer_bench --resources 20 --files 10 \\
+        --payload-size 1048576 --concurrency 4
+
+"""
+from __future__ import print_function
+
+import base64
+import os
+import resource
+import threading
+import time
+import uuid
+
+import boto3
+import click
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from moto import mock_s3
+from moto.core.models import botocore_stubber
+
+from customresources.s3writer import lambda_function
+from tools.standins import (
+    FakeCloudFormation,
+    FakeContext,
+    FakeLambda,
+    ResponseServer,
+)
+
+
+BUCKET = "s3writer-bench"
+SOURCE_BUCKET = "s3writer-bench-source"
+STACK_ID = "arn:aws:cloudformation:us-east-1:000000000000:stack/bench/0"
+
+
+class BenchError(Exception):
+    """A response or the bucket contents weren't as expected"""
+
+
+def expect(condition, message, *args):
+    if not condition:
+        raise BenchError(message % args)
+
+
+def make_event(request_type, logical_id, properties, response_url,
+               physical_resource_id=None, old_properties=None):
+    """Fabricate a CloudFormation custom resource request"""
+    event = {
+        "RequestType": request_type,
+        "ResponseURL": response_url,
+        "StackId": STACK_ID,
+        "RequestId": str(uuid.uuid4()),
+        "ResourceType": "Custom::S3Writer",
+        "LogicalResourceId": logical_id,
+        "ResourceProperties": properties,
+    }
+    if physical_resource_id is not None:
+        event["PhysicalResourceId"] = physical_resource_id
+    if old_properties is not None:
+        event["OldResourceProperties"] = old_properties
+    return event
+
+
+def check_response(event, response, physical_resource_id=None):
+    """Check a response follows the custom resource protocol"""
+    for field in ("StackId", "RequestId", "LogicalResourceId"):
+        expect(response[field] == event[field], "%s mismatch: %r", field,
+               response[field])
+    expect(response["Status"] == lambda_function.SUCCESS, "%s failed: %s",
+           event["RequestType"], response["Data"])
+    expect(response["PhysicalResourceId"], "Missing PhysicalResourceId")
+    if physical_resource_id is not None:
+        expect(response["PhysicalResourceId"] == physical_resource_id,
+               "PhysicalResourceId changed: %s -> %s", physical_resource_id,
+               response["PhysicalResourceId"])
+    expect(isinstance(response["Data"], dict), "Data must be an object")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(int(round(pct / 100.0 * (len(ordered) - 1))),
+                len(ordered) - 1)
+    return ordered[index]
+
+
+def make_properties(index, files, payload_size):
+    prefix = "bench/%d/" % index
+    payload = base64.urlsafe_b64encode(os.urandom(payload_size))
+    return {
+        "Bucket": BUCKET,
+        "Prefix": prefix,
+        "Files": [
+            {"Key": "%sfile-%d" % (prefix, number), "Content": payload}
+            for number in range(files)
+        ],
+    }
+
+
+class Harness(object):
+    """Runs the S3 writer handler against moto's S3 and local stand-ins
+
+    Each scenario takes a resource index and runs one resource through
+    its requests, raising BenchError when anything is off. Create it
+    within ``mock_s3``.
+
+    moto's S3 backend isn't thread-safe, so its requests are answered one
+    at a time. Latencies are of the handler against moto, not S3.
+
+    """
+    def __init__(self, server, files, payload_size, prefix_objects,
+                 timeout=300):
+        self.server = server
+        self.files = files
+        self.payload_size = payload_size
+        self.prefix_objects = prefix_objects
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket=BUCKET)
+        self.s3.create_bucket(Bucket=SOURCE_BUCKET)
+        self.s3_requests = 0
+        # Every before-send handler runs, so moto's own one is replaced
+        self.s3.meta.events.unregister("before-send", botocore_stubber)
+        self.s3.meta.events.register("before-send.s3", self._send)
+        self.lambda_client = FakeLambda(self.invoke, self.context)
+        self.cloudformation = FakeCloudFormation()
+        # Point the handler's warm client cache at the stand-ins
+        lambda_function._clients["s3"] = self.s3
+        lambda_function._clients["lambda"] = self.lambda_client
+        lambda_function._clients["cloudformation"] = self.cloudformation
+        # Source objects to copy; the large one is copied in three parts
+        self.sources = {
+            "small": os.urandom(payload_size),
+            "large": os.urandom(2 * lambda_function.MIN_PART_SIZE + 1),
+        }
+        for key, body in self.sources.items():
+            self.s3.put_object(Bucket=SOURCE_BUCKET, Key=key, Body=body)
+        self.s3_requests = 0
+        self.latencies = {}
+        self.continuations = 0
+
+    def _send(self, **kwargs):
+        """Answer an S3 request from moto, one request at a time"""
+        with self._lock:
+            self.s3_requests += 1
+            return botocore_stubber(**kwargs)
+
+    def context(self, time_checks=None):
+        return FakeContext(self.timeout, time_checks)
+
+    def invoke(self, event, context=None):
+        if event.get("Continuation"):
+            with self._lock:
+                self.continuations += 1
+        return lambda_function.lambda_handler(event, context or
+                                              self.context())
+
+    def request(self, request_type, logical_id, properties,
+                physical_resource_id=None, old_properties=None,
+                context=None):
+        """Send one request and return its checked response"""
+        event = make_event(request_type, logical_id, properties,
+                           self.server.url, physical_resource_id,
+                           old_properties)
+        started = time.time()
+        self.invoke(event, context)
+        response = self.server.wait_for(event["RequestId"])
+        with self._lock:
+            self.latencies.setdefault(request_type, []).append(
+                time.time() - started)
+        check_response(event, response, physical_resource_id)
+        return response
+
+    def body(self, key):
+        """The body of an object in the bucket, None if there is none"""
+        try:
+            return self.s3.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            return None
+
+    def expect_objects(self, keys, present=True):
+        for key in keys:
+            expect((self.body(key) is not None) == present, "%s %s",
+                   key, "not written" if present else "left behind")
+
+    def expect_empty(self, prefix):
+        remaining = self.s3.list_objects(
+            Bucket=BUCKET, Prefix=prefix).get("Contents", [])
+        expect(not remaining, "%d objects left under %s", len(remaining),
+               prefix)
+
+    def files_cycle(self, index):
+        """Create, Update unchanged, Update changed, then Delete
+
+        The changed Update also drops the last file, which must be
+        deleted without replacing the resource.
+
+        """
+        logical_id = "BenchFiles%d" % index
+        props = make_properties(index, self.files, self.payload_size)
+        keys = [f["Key"] for f in props["Files"]]
+        created = self.request("Create", logical_id, props)
+        arn = created["PhysicalResourceId"]
+        self.expect_objects(keys)
+
+        unchanged = self.request("Update", logical_id, props, arn, props)
+        expect(unchanged["Data"]["Written"] == "0",
+               "Unchanged update re-wrote %s files",
+               unchanged["Data"]["Written"])
+
+        changed_props = dict(props)
+        changed_props["Files"] = [dict(f) for f in
+                                  props["Files"][:-1] or props["Files"]]
+        changed_props["Files"][0]["Content"] = {"changed": time.time()}
+        changed = self.request("Update", logical_id, changed_props, arn,
+                               props)
+        expect(changed["Data"]["Written"] == "1",
+               "Changed update wrote %s files", changed["Data"]["Written"])
+        expect(changed["Data"]["Count"] == str(len(changed_props["Files"])),
+               "Changed update counted %s files", changed["Data"]["Count"])
+        self.expect_objects(keys[len(changed_props["Files"]):],
+                            present=False)
+
+        self.request("Delete", logical_id, changed_props, arn)
+        self.expect_empty(props["Prefix"])
+
+    def single_file_cycle(self, index):
+        """The same cycle for a resource that is itself one file"""
+        logical_id = "BenchFile%d" % index
+        props = {"Bucket": BUCKET, "Key": "single/%d.json" % index,
+                 "Content": {"index": index}}
+        created = self.request("Create", logical_id, props)
+        arn = created["PhysicalResourceId"]
+        self.expect_objects([props["Key"]])
+
+        unchanged = self.request("Update", logical_id, props, arn, props)
+        expect(unchanged["Data"]["Written"] == "0",
+               "Unchanged update re-wrote %s", props["Key"])
+
+        changed_props = dict(props, Content={"changed": time.time()})
+        changed = self.request("Update", logical_id, changed_props, arn,
+                               props)
+        expect(changed["Data"]["Written"] == "1",
+               "Changed update didn't write %s", props["Key"])
+
+        self.request("Delete", logical_id, changed_props, arn)
+        self.expect_objects([props["Key"]], present=False)
+
+    def source_cycle(self, index):
+        """Server-side copies, the large one as a multipart copy"""
+        logical_id = "BenchCopies%d" % index
+        prefix = "copies/%d/" % index
+        props = {
+            "Bucket": BUCKET,
+            "Prefix": prefix,
+            "MultipartThreshold": str(lambda_function.MIN_PART_SIZE),
+            "Files": [
+                {"Key": prefix + name,
+                 "Source": {"Bucket": SOURCE_BUCKET, "Key": name}}
+                for name in sorted(self.sources)
+            ],
+        }
+        created = self.request("Create", logical_id, props)
+        arn = created["PhysicalResourceId"]
+        for name, body in self.sources.items():
+            expect(self.body(prefix + name) == body,
+                   "%s%s wasn't copied intact", prefix, name)
+
+        unchanged = self.request("Update", logical_id, props, arn, props)
+        expect(unchanged["Data"]["Written"] == "0",
+               "Unchanged update re-copied %s files",
+               unchanged["Data"]["Written"])
+
+        self.request("Delete", logical_id, props, arn)
+        self.expect_empty(prefix)
+
+    def continuation_cycle(self, index):
+        """A prefix Delete that runs out of time after its first page
+
+        The response must only arrive once a continuation invocation
+        has deleted the rest.
+
+        """
+        logical_id = "BenchPrefix%d" % index
+        prefix = "continued/%d/" % index
+        props = {"Bucket": BUCKET, "Prefix": prefix}
+        created = self.request("Create", logical_id, props)
+        arn = created["PhysicalResourceId"]
+        for number in range(self.prefix_objects):
+            self.s3.put_object(Bucket=BUCKET, Key="%s%d" % (prefix, number),
+                               Body="x")
+
+        self.request("Delete", logical_id, props, arn,
+                     context=self.context(time_checks=0))
+        self.expect_empty(prefix)
+
+    def scenarios(self):
+        return [self.files_cycle, self.single_file_cycle, self.source_cycle,
+                self.continuation_cycle]
+
+
+@click.command()
+@click.option("--resources", default=10,
+              help="Resources to cycle through per scenario")
+@click.option("--files", default=5, help="Files per resource")
+@click.option("--payload-size", default=64 * 1024,
+              help="Decoded bytes per file")
+@click.option("--concurrency", default=4,
+              help="Concurrent handler invocations")
+@click.option("--prefix-objects",
+              default=2 * lambda_function.DELETE_BATCH_SIZE,
+              help="Objects under the prefix of a continued delete")
+def main(resources, files, payload_size, concurrency, prefix_objects):
+    if prefix_objects <= lambda_function.DELETE_BATCH_SIZE:
+        raise click.BadParameter(
+            "must be over %d to need a continuation" %
+            lambda_function.DELETE_BATCH_SIZE, param_hint="--prefix-objects")
+    with mock_s3(), ResponseServer() as server:
+        harness = Harness(server, files, payload_size, prefix_objects)
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(scenario, index)
+                       for index in range(resources)
+                       for scenario in harness.scenarios()]
+            try:
+                for future in futures:
+                    future.result()
+            except (BenchError, RuntimeError) as exc:
+                raise click.ClickException(str(exc))
+        harness.lambda_client.join()
+    elapsed = time.time() - started
+
+    click.echo("%d resources per scenario, %d files of %d bytes, "
+               "concurrency %d, %.2fs total, %d S3 requests, "
+               "%d continuations" % (
+                   resources, files, payload_size, concurrency, elapsed,
+                   harness.s3_requests, harness.continuations))
+    click.echo("%-8s %6s %9s %9s %9s %9s" % (
+        "request", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for request_type in ("Create", "Update", "Delete"):
+        values = harness.latencies.get(request_type, [])
+        click.echo("%-8s %6d %9.1f %9.1f %9.1f %9.1f" % (
+            request_type, len(values),
+            percentile(values, 50) * 1000,
+            percentile(values, 90) * 1000,
+            percentile(values, 99) * 1000,
+            max(values or [0]) * 1000,
+        ))
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    click.echo("peak memory: %.1f MB" % (peak / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,486 @@
+"""In-process stand-ins for the AWS services used by the stack's Lambdas
+
+These implement just enough of the boto3 client API for the Lambda code
+in this repo to run offline, without moto or network access.
+
+"""
+from __future__ import print_function
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from customresources.cfnresponse import MAX_RESPONSE_BODY
+
+
+def _client_error(code, message, operation):
+    return ClientError({"Error": {"Code": code, "Message": message}},
+                       operation)
+
+
+class FakeS3(object):
+    """Thread-safe in-memory S3 client"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (bucket, key) -> object dict
+        self.objects = {}
+        # upload id -> {part number: body}
+        self._uploads = {}
+        self._upload_meta = {}
+        self.requests = 0
+
+    def _count(self):
+        with self._lock:
+            self.requests += 1
+
+    def _get(self, bucket, key, operation):
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise _client_error("404", "Not Found", operation)
+
+    def _store(self, bucket, key, body, content_type=None, metadata=None,
+               etag=None):
+        with self._lock:
+            self.objects[(bucket, key)] = dict(
+                Body=body,
+                ContentType=content_type or "binary/octet-stream",
+                Metadata=metadata or {},
+                ETag='"%s"' % (etag or hashlib.md5(body).hexdigest()),
+            )
+
+    def preload(self, Bucket, Key, Body):
+        """Store an object without counting it as a request"""
+        self._store(Bucket, Key, Body)
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, Metadata=None):
+        self._count()
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        self._store(Bucket, Key, Body, ContentType, Metadata)
+        return {"ETag": self.objects[(Bucket, Key)]["ETag"]}
+
+    def get_object(self, Bucket, Key):
+        self._count()
+        obj = self._get(Bucket, Key, "GetObject")
+        return dict(obj, Body=_Body(obj["Body"]),
+                    ContentLength=len(obj["Body"]))
+
+    def download_file(self, Bucket, Key, Filename):
+        with open(Filename, "wb") as out:
+            out.write(self.get_object(Bucket, Key)["Body"].read())
+
+    def head_object(self, Bucket, Key):
+        self._count()
+        obj = self._get(Bucket, Key, "HeadObject")
+        return dict(ContentLength=len(obj["Body"]),
+                    ContentType=obj["ContentType"],
+                    Metadata=obj["Metadata"],
+                    ETag=obj["ETag"])
+
+    def copy_object(self, Bucket, Key, CopySource, ContentType=None,
+                    Metadata=None, MetadataDirective="COPY"):
+        self._count()
+        src = self._get(CopySource["Bucket"], CopySource["Key"],
+                        "CopyObject")
+        if MetadataDirective != "REPLACE":
+            ContentType, Metadata = src["ContentType"], src["Metadata"]
+        self._store(Bucket, Key, src["Body"], ContentType, Metadata)
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None,
+                                Metadata=None):
+        self._count()
+        with self._lock:
+            upload_id = "upload-%d" % len(self._upload_meta)
+            self._uploads[upload_id] = {}
+            self._upload_meta[upload_id] = (ContentType, Metadata)
+        return {"UploadId": upload_id}
+
+    def _add_part(self, upload_id, number, body):
+        with self._lock:
+            self._uploads[upload_id][number] = body
+        return '"%s"' % hashlib.md5(body).hexdigest()
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._count()
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        return {"ETag": self._add_part(UploadId, PartNumber, Body)}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource,
+                         CopySourceRange):
+        self._count()
+        src = self._get(CopySource["Bucket"], CopySource["Key"],
+                        "UploadPartCopy")
+        first, last = CopySourceRange.split("=")[1].split("-")
+        body = src["Body"][int(first):int(last) + 1]
+        return {"CopyPartResult": {
+            "ETag": self._add_part(UploadId, PartNumber, body)}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        self._count()
+        with self._lock:
+            parts = self._uploads.pop(UploadId)
+            content_type, metadata = self._upload_meta[UploadId]
+        numbers = [p["PartNumber"] for p in MultipartUpload["Parts"]]
+        body = "".join(parts[number] for number in numbers)
+        digest = hashlib.md5("".join(
+            hashlib.md5(parts[number]).digest() for number in numbers))
+        etag = "%s-%d" % (digest.hexdigest(), len(numbers))
+        self._store(Bucket, Key, body, content_type, metadata, etag)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._count()
+        with self._lock:
+            self._uploads.pop(UploadId, None)
+
+    def delete_objects(self, Bucket, Delete):
+        self._count()
+        with self._lock:
+            for obj in Delete["Objects"]:
+                self.objects.pop((Bucket, obj["Key"]), None)
+        return {"Deleted": Delete["Objects"]}
+
+    def list_keys(self, Bucket, Prefix=""):
+        with self._lock:
+            return sorted(key for bucket, key in self.objects
+                          if bucket == Bucket and key.startswith(Prefix))
+
+    def get_paginator(self, operation):
+        if operation != "list_objects":
+            raise NotImplementedError(operation)
+        return _ListObjectsPaginator(self)
+
+
+class _Body(object):
+    def __init__(self, data):
+        self._data = data
+
+    def read(self):
+        return self._data
+
+
+class _ListObjectsPaginator(object):
+    def __init__(self, s3):
+        self._s3 = s3
+
+    def paginate(self, Bucket, Prefix="", PaginationConfig=None):
+        page_size = (PaginationConfig or {}).get("PageSize", 1000)
+        marker = ""
+        while True:
+            self._s3._count()
+            keys = [key for key in self._s3.list_keys(Bucket, Prefix)
+                    if key > marker][:page_size]
+            yield {"Contents": [{"Key": key} for key in keys],
+                   "IsTruncated": len(keys) == page_size}
+            if len(keys) < page_size:
+                return
+            marker = keys[-1]
+
+
+class FakeLambda(object):
+    """Lambda client whose asynchronous invokes run a handler in a thread"""
+    def __init__(self, handler, context_factory):
+        self._handler = handler
+        self._context_factory = context_factory
+        self.threads = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        thread = threading.Thread(
+            target=self._handler,
+            args=(json.loads(Payload), self._context_factory()),
+        )
+        thread.start()
+        self.threads.append(thread)
+        return {"StatusCode": 202}
+
+    def join(self):
+        while self.threads:
+            self.threads.pop().join()
+
+
+class FakeCloudFormation(object):
+    """CloudFormation client describing every stack in one status"""
+    def __init__(self, status="DELETE_IN_PROGRESS"):
+        self.status = status
+
+    def describe_stacks(self, StackName):
+        return {"Stacks": [{"StackId": StackName, "StackName": StackName,
+                            "StackStatus": self.status}]}
+
+
+class FakeElastiCache(object):
+    """ElastiCache client describing every cluster at one endpoint"""
+    def __init__(self, host="127.0.0.1", port=6379):
+        self.host = host
+        self.port = port
+
+    def describe_cache_clusters(self, CacheClusterId=None,
+                                ShowCacheNodeInfo=False, **kwargs):
+        endpoint = {"Address": self.host, "Port": self.port}
+        return {"CacheClusters": [{
+            "CacheClusterId": CacheClusterId or "local",
+            "Engine": "redis",
+            "CacheClusterStatus": "available",
+            "CacheNodes": [{"CacheNodeId": "0001", "Endpoint": endpoint}],
+        }]}
+
+
+class FakeRedis(object):
+    """Thread-safe in-memory Redis counting commands and round trips
+
+    Implements the commands the Push processors use on strings, hashes,
+    lists and sorted sets. latency simulates the network round trip of
+    each command or pipeline in seconds.
+
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.data = {}
+        self.ops = {}
+        self.round_trips = 0
+
+    def _round_trip(self, commands):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.round_trips += 1
+            for name in commands:
+                self.ops[name] = self.ops.get(name, 0) + 1
+
+    def execute(self, name, *args, **kwargs):
+        """Run one command without counting it"""
+        with self._lock:
+            return getattr(self, "_" + name)(*args, **kwargs)
+
+    def _command(name):
+        def command(self, *args, **kwargs):
+            self._round_trip([name])
+            return self.execute(name, *args, **kwargs)
+        command.__name__ = name
+        return command
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+    def _get(self, key):
+        return self.data.get(key)
+
+    def _set(self, key, value, ex=None):
+        self.data[key] = str(value)
+        return True
+
+    def _incrby(self, key, amount=1):
+        value = int(self.data.get(key, 0)) + int(amount)
+        self.data[key] = str(value)
+        return value
+
+    def _incr(self, key, amount=1):
+        return self._incrby(key, amount)
+
+    def _delete(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def _expire(self, key, seconds):
+        return key in self.data
+
+    def _hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = str(value)
+        return 1
+
+    def _hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def _hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def _hincrby(self, key, field, amount=1):
+        fields = self.data.setdefault(key, {})
+        fields[field] = str(int(fields.get(field, 0)) + int(amount))
+        return int(fields[field])
+
+    def _lpush(self, key, *values):
+        items = self.data.setdefault(key, [])
+        for value in values:
+            items.insert(0, str(value))
+        return len(items)
+
+    def _rpush(self, key, *values):
+        items = self.data.setdefault(key, [])
+        items.extend(str(value) for value in values)
+        return len(items)
+
+    def _ltrim(self, key, start, end):
+        items = self.data.get(key, [])
+        end = len(items) if end == -1 else end + 1
+        self.data[key] = items[start:end]
+        return True
+
+    def _lrange(self, key, start, end):
+        items = self.data.get(key, [])
+        end = len(items) if end == -1 else end + 1
+        return items[start:end]
+
+    def _zadd(self, key, *args, **kwargs):
+        scores = self.data.setdefault(key, {})
+        pairs = list(zip(args[1::2], args[::2])) + list(kwargs.items())
+        for member, score in pairs:
+            scores[str(member)] = float(score)
+        return len(pairs)
+
+    def _zincrby(self, key, member, amount=1):
+        scores = self.data.setdefault(key, {})
+        scores[str(member)] = scores.get(str(member), 0.0) + float(amount)
+        return scores[str(member)]
+
+    get = _command("get")
+    set = _command("set")
+    incr = _command("incr")
+    incrby = _command("incrby")
+    delete = _command("delete")
+    expire = _command("expire")
+    hset = _command("hset")
+    hget = _command("hget")
+    hgetall = _command("hgetall")
+    hincrby = _command("hincrby")
+    lpush = _command("lpush")
+    rpush = _command("rpush")
+    ltrim = _command("ltrim")
+    lrange = _command("lrange")
+    zadd = _command("zadd")
+    zincrby = _command("zincrby")
+    del _command
+
+
+class _FakePipeline(object):
+    """Buffers commands and runs them in one round trip"""
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+
+    def __getattr__(self, name):
+        if not hasattr(self._redis, "_" + name):
+            raise AttributeError(name)
+
+        def buffer(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return buffer
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        self._redis._round_trip([name for name, _, _ in commands])
+        return [self._redis.execute(name, *args, **kwargs)
+                for name, args, kwargs in commands]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._commands = []
+
+
+class FakeContext(object):
+    """Lambda context with a deadline
+
+    With time_checks, it reports no time left once the remaining time
+    has been asked for that many times, to force timeouts.
+
+    """
+    function_name = "local"
+    invoked_function_arn = \
+        "arn:aws:lambda:us-east-1:000000000000:function:local"
+    log_stream_name = "local/log-stream"
+
+    def __init__(self, timeout=300, time_checks=None):
+        self._deadline = time.time() + timeout
+        self._time_checks = time_checks
+
+    def get_remaining_time_in_millis(self):
+        if self._time_checks is not None:
+            if self._time_checks <= 0:
+                return 0
+            self._time_checks -= 1
+        return int(max(self._deadline - time.time(), 0) * 1000)
+
+
+class _ResponseHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        response = json.loads(body)
+        if len(body) > MAX_RESPONSE_BODY:
+            self.server.reject(response["RequestId"], len(body))
+            self.send_response(400)
+        else:
+            self.server.record(response)
+            self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ResponseServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server standing in for a CloudFormation ResponseURL
+
+    Response bodies are kept by RequestId. Like CloudFormation, bodies
+    over MAX_RESPONSE_BODY bytes are rejected.
+
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           _ResponseHandler)
+        self.responses = {}
+        # RequestId -> size of the rejected body
+        self.rejected = {}
+        self._received = threading.Condition()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_port
+
+    def record(self, body):
+        with self._received:
+            self.responses[body["RequestId"]] = body
+            self._received.notify_all()
+
+    def reject(self, request_id, size):
+        with self._received:
+            self.rejected[request_id] = size
+            self._received.notify_all()
+
+    def wait_for(self, request_id, timeout=30):
+        """Returns the response body sent for a request"""
+        deadline = time.time() + timeout
+        with self._received:
+            while request_id not in self.responses:
+                if request_id in self.rejected:
+                    raise RuntimeError(
+                        "Response for %s is %d bytes, over the %d byte "
+                        "limit" % (request_id, self.rejected[request_id],
+                                   MAX_RESPONSE_BODY))
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError("No response for %s" % request_id)
+                self._received.wait(remaining)
+            return self.responses[request_id]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()